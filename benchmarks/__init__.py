@@ -0,0 +1,7 @@
+"""Benchmarks of pif at library scale.
+
+Synthetic image trees and Flickr photostreams are generated on the fly; the
+photostream is served by a local stand-in for Flickr. Run with:
+
+    python -m benchmarks [options]
+"""
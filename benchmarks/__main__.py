@@ -0,0 +1,329 @@
+import json
+import logging
+import optparse
+import os
+import os.path
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import pif
+import pif.dictdb
+import pif.flickr
+import pif.hash
+import pif.local
+import pif.ui.console
+
+from benchmarks.fixtures import Photostream, Proxy, Server, make_tree
+
+CASES = []
+
+RE_IMAGES = pif.ui.console.ConsoleShell.RE_IMAGES
+
+
+def case(function):
+    """Register a benchmark, run as function(env, timer), returning a count."""
+
+    CASES.append(function)
+    return function
+
+
+class Timer(object):
+    """Accumulate the time spent in its with blocks."""
+
+    def __init__(self):
+        self.seconds = 0.0
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.seconds += time.time() - self.start
+
+
+class Environment(object):
+    """The fixtures shared by the benchmarks: an image tree and a Flickr."""
+
+    def __init__(self, options):
+        self.options = options
+        self.root = tempfile.mkdtemp(prefix='pif-benchmarks-')
+
+        self.tree = os.path.join(self.root, 'tree')
+        self.filenames = make_tree(self.tree, options.files, seed=options.seed)
+
+        # Half the tree is already on Flickr, among the synthetic photos.
+        self.photostream = Photostream()
+        self.photostream.add_synthetic(options.photos, seed=options.seed)
+
+        for fn in self.filenames[::2]:
+            self.photostream.add_file(fn)
+
+        self.server = Server(self.photostream)
+
+    def proxy(self):
+        return Proxy(self.server.url)
+
+    def mkdtemp(self):
+        return tempfile.mkdtemp(dir=self.root)
+
+    def close(self):
+        self.server.close()
+        shutil.rmtree(self.root)
+
+
+def _records(count, seed):
+    r = random.Random(seed)
+
+    return dict((str(i), {
+        'lastupdate': 1200000000 + i,
+        'originalformat': r.choice(('jpg', 'png')),
+        'o_width': r.randint(640, 5000),
+        'o_height': r.randint(480, 5000),
+    }) for i in xrange(count))
+
+
+@case
+def dictdb_sync(env, timer):
+    records = _records(env.options.photos, env.options.seed)
+    db = pif.dictdb.DictDB(os.path.join(env.mkdtemp(), 'dict.db'))
+
+    with timer:
+        for k, v in records.iteritems():
+            db[k] = v
+
+        db.sync()
+
+    return len(records)
+
+
+@case
+def dictdb_load(env, timer):
+    records = _records(env.options.photos, env.options.seed)
+    fn = os.path.join(env.mkdtemp(), 'dict.db')
+
+    db = pif.dictdb.DictDB(fn)
+    db.update(records)
+    db.sync()
+
+    keys = random.Random(env.options.seed).sample(records, len(records) // 10)
+
+    with timer:
+        db = pif.dictdb.DictDB(fn)
+
+        for k in keys:
+            db[k]
+
+        count = sum(1 for kv in db.iteritems())
+
+    return count + len(keys)
+
+
+def _scan(dirs, files, top):
+    count = 0
+
+    for fn, shorthash in files.hash_many(dirs.walk(top, RE_IMAGES.match)):
+        count += 1
+
+    dirs.sync()
+    files.sync()
+
+    return count
+
+
+@case
+def files_scan(env, timer):
+    d = env.mkdtemp()
+
+    with timer:
+        return _scan(pif.local.DirectoryIndex(os.path.join(d, 'dirs.db')),
+                     pif.local.FileIndex(os.path.join(d, 'files.db')),
+                     env.tree)
+
+
+@case
+def files_rescan(env, timer):
+    d = env.mkdtemp()
+    dirs_db, files_db = os.path.join(d, 'dirs.db'), os.path.join(d, 'files.db')
+
+    _scan(pif.local.DirectoryIndex(dirs_db), pif.local.FileIndex(files_db),
+          env.tree)
+
+    with timer:
+        return _scan(pif.local.DirectoryIndex(dirs_db),
+                     pif.local.FileIndex(files_db),
+                     env.tree)
+
+
+@case
+def photos_refresh(env, timer):
+    photos = pif.flickr.PhotoIndex(env.proxy(),
+                                   os.path.join(env.mkdtemp(), 'photos.db'))
+
+    with timer:
+        count = len(photos.refresh())
+        photos.sync()
+
+    return count
+
+
+@case
+def hashes_refresh(env, timer):
+    d = env.mkdtemp()
+    photos = pif.flickr.PhotoIndex(env.proxy(), os.path.join(d, 'photos.db'))
+    hashes = pif.hash.HashIndex(photos, os.path.join(d, 'hashes.db'))
+
+    with timer:
+        hashes.refresh()
+
+    return len(photos)
+
+
+@case
+def merge_shorthashes(env, timer):
+    r = random.Random(env.options.seed)
+    hashes = pif.hash.HashIndex(None,
+                                os.path.join(env.mkdtemp(), 'hashes.db'))
+
+    # One in ten photos duplicates another and one in ten is replaced.
+    shorthashes = [pif.make_shorthash(str(i), 'jpg', i, 640, 480)
+                   for i in xrange(env.options.photos)]
+    updates = dict((str(i), r.choice(shorthashes) if i % 10 == 0 else sh)
+                   for i, sh in enumerate(shorthashes))
+    replaced = dict((pid, shorthashes[r.randrange(len(shorthashes))])
+                    for pid in r.sample(updates, len(updates) // 10))
+
+    batches = []
+
+    for photo_shorthashes in (updates, replaced):
+        items = photo_shorthashes.items()
+
+        for i in xrange(0, len(items), hashes.CHECKPOINT):
+            batches.append(dict(items[i:i + hashes.CHECKPOINT]))
+
+    with timer:
+        for batch in batches:
+            hashes._merge_shorthashes(batch)
+
+        hashes.sync()
+
+    return len(updates) + len(replaced)
+
+
+class Shell(pif.ui.console.ConsoleShell):
+    """A console shell against the local Flickr."""
+
+    def __init__(self, env, config_dir, args):
+        pif.ui.console.ConsoleShell.__init__(self, args)
+
+        self.env = env
+        self.config_dir = config_dir
+
+    def make_index(self, *args, **kwargs):
+        kwargs['config_dir'] = self.config_dir
+
+        index = pif.ui.console.ConsoleShell.make_index(self, *args, **kwargs)
+        index.proxy = self.env.proxy()
+
+        return index
+
+
+@case
+def console_run(env, timer):
+    shell = Shell(env, env.mkdtemp(), ['--dry-run', env.tree])
+
+    with timer:
+        shell.run()
+
+    return len(env.filenames)
+
+
+def _run(env, function, repeat):
+    """Run a benchmark repeatedly, keeping the best time."""
+
+    runs, items = [], 0
+
+    for i in xrange(repeat):
+        timer = Timer()
+        items = function(env, timer)
+        runs.append(timer.seconds)
+
+    seconds = min(runs)
+
+    return {
+        'seconds': seconds,
+        'runs': runs,
+        'items': items,
+        'per_second': items / seconds if seconds else None,
+    }
+
+
+def main(args=None):
+    parser = optparse.OptionParser('%prog [options] [benchmark ...]')
+    parser.add_option('--files', type='int', default=1000,
+                      help='images in the local tree (default: %default)')
+    parser.add_option('--photos', type='int', default=10000,
+                      help='synthetic photos on Flickr (default: %default)')
+    parser.add_option('--repeat', type='int', default=3,
+                      help='runs of each benchmark (default: %default)')
+    parser.add_option('--seed', type='int', default=0,
+                      help='seed for the generated data (default: %default)')
+    parser.add_option('-o', '--output', metavar='FILE',
+                      help='write the results to FILE, as JSON')
+    parser.add_option('--compare', metavar='FILE',
+                      help='report the speedup over the results in FILE')
+    options, names = parser.parse_args(args)
+
+    cases = [c for c in CASES if not names or c.__name__ in names]
+
+    if not cases:
+        parser.error("no benchmark named %s" % ', '.join(names))
+
+    baseline = {}
+
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)['results']
+
+    logging.basicConfig()
+    logging.root.setLevel(logging.WARN)
+
+    results = {}
+    env = Environment(options)
+
+    try:
+        for c in cases:
+            name = c.__name__
+            r = results[name] = _run(env, c, options.repeat)
+
+            line = "%-20s %10.3fs %10u items %12.1f/s" % (
+                name, r['seconds'], r['items'], r['per_second'] or 0)
+
+            if name in baseline and r['seconds']:
+                line += "  %5.2fx" % (baseline[name]['seconds'] / r['seconds'])
+
+            print line
+            sys.stdout.flush()
+    finally:
+        env.close()
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({
+                'parameters': {
+                    'files': options.files,
+                    'photos': options.photos,
+                    'repeat': options.repeat,
+                    'seed': options.seed,
+                },
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'time': time.time(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
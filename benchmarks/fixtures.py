@@ -0,0 +1,275 @@
+import BaseHTTPServer
+import bisect
+import cgi
+import hashlib
+import math
+import os
+import os.path
+import random
+import socket
+import SocketServer
+import StringIO
+import threading
+import urllib
+import urllib2
+import urlparse
+
+from xml.etree.ElementTree import XML
+from xml.sax.saxutils import quoteattr
+
+import PIL.Image
+import PIL.ImageDraw
+
+from pif import TAILHASH_SIZE
+
+EXTRAS = ('dateupload', 'lastupdate', 'originalformat', 'o_width', 'o_height',
+          'url_o')
+
+
+def make_tree(root, count, per_dir=100, seed=0):
+    """Generate a tree of distinct images, returning their filenames."""
+
+    r = random.Random(seed)
+    filenames = []
+
+    for i in xrange(count):
+        path = os.path.join(root, "d%04u" % (i // per_dir))
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        format = r.choice(('jpg', 'png'))
+        size = r.randint(64, 160), r.randint(48, 120)
+        color = tuple(r.randint(0, 255) for c in 'rgb')
+
+        image = PIL.Image.new('RGB', size, color)
+        PIL.ImageDraw.ImageDraw(image).text((2, 2), str(i))
+
+        fn = os.path.join(path, "img%06u.%s" % (i, format))
+        image.save(fn)
+        filenames.append(fn)
+
+    return filenames
+
+
+class Photostream(object):
+    """A fake Flickr photostream.
+
+    Photos are either synthetic, with a tail derived from their ID, or copies
+    of files, so that those files are known to be uploaded."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        self.photos = {}    # photo ID: (attributes, source)
+        self.next_id = 1000000
+        self.time = 1200000000
+
+        # The attributes and last update times, oldest first. The time only
+        # goes forward, so appending keeps them sorted.
+        self.updates = []
+        self.update_times = []
+
+    def _add(self, format, width, height, source):
+        with self.lock:
+            pid = str(self.next_id)
+            self.next_id += 1
+            self.time += 1
+
+            attributes = {
+                'id': pid,
+                'dateupload': str(self.time),
+                'lastupdate': str(self.time),
+                'originalformat': format,
+                'o_width': str(width),
+                'o_height': str(height),
+                'url_o': "/photos/%s_o.%s" % (pid, format),
+            }
+
+            self.photos[pid] = attributes, source
+            self.updates.append(attributes)
+            self.update_times.append(self.time)
+
+        return pid
+
+    def add_synthetic(self, count, seed=0):
+        r = random.Random(seed)
+
+        for i in xrange(count):
+            self._add(r.choice(('jpg', 'gif', 'png')),
+                      r.randint(640, 5000), r.randint(480, 5000),
+                      r.randint(TAILHASH_SIZE, 20 * 1024 * 1024))
+
+    def add_data(self, data):
+        """Add an uploaded image, returning its photo ID."""
+
+        image = PIL.Image.open(StringIO.StringIO(data))
+
+        return self._add(image.format.lower(), image.size[0], image.size[1],
+                         data)
+
+    def add_file(self, filename):
+        with open(filename, 'rb') as f:
+            return self.add_data(f.read())
+
+    def tail(self, pid, length):
+        """Get the size and the last length bytes of a photo."""
+
+        attributes, source = self.photos[pid]
+
+        if isinstance(source, str):
+            return len(source), source[-length:]
+
+        size = source
+        tail = hashlib.sha512(pid).digest() * (TAILHASH_SIZE // 64)
+
+        return size, tail[-min(length, size):]
+
+    def recently_updated(self, min_date=0):
+        with self.lock:
+            i = bisect.bisect_left(self.update_times, min_date)
+
+            return self.updates[i:]
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Flickr's REST API, original photos and uploads, just enough for pif."""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, code, body, headers=()):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+
+        for k, v in headers:
+            self.send_header(k, v)
+
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _rsp(self, body):
+        self._send(200, '<rsp stat="ok">%s</rsp>' % body,
+                   [('Content-Type', 'text/xml')])
+
+    def _photos(self, photos, params, extras):
+        per_page = int(params.get('per_page', 100))
+        page = int(params.get('page', 1))
+        total = len(photos)
+        pages = int(math.ceil(total / float(per_page)))
+
+        def _(photo, k):
+            if k == 'url_o':    # Served from here.
+                return quoteattr(self.server.url + photo[k])
+
+            return quoteattr(photo[k])
+
+        self._rsp('<photos page="%u" pages="%u" perpage="%u" total="%u">%s'
+                  '</photos>' % (page, pages, per_page, total, ''.join(
+                      '<photo %s />' % ' '.join(
+                          "%s=%s" % (k, _(p, k)) for k in ('id', ) + extras)
+                      for p in photos[(page - 1) * per_page:page * per_page])))
+
+    def do_GET(self):
+        path = urlparse.urlparse(self.path).path
+        pid = os.path.basename(path).split('_')[0]
+
+        if not path.startswith('/photos/') \
+           or pid not in self.server.photostream.photos:
+            return self._send(404, '')
+
+        length = int(self.headers['Range'].split('-')[-1])
+        size, tail = self.server.photostream.tail(pid, length)
+
+        self._send(206, tail, [('Content-Range', "bytes %u-%u/%u" % (
+            size - len(tail), size - 1, size))])
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        stream = self.server.photostream
+
+        if url.path == '/upload':
+            return self._rsp('<photoid>%s</photoid>' % stream.add_data(body))
+
+        params = dict(cgi.parse_qsl(body))
+        method = params.get('method')
+
+        if method == 'flickr.photos.recentlyUpdated':
+            photos = stream.recently_updated(int(params.get('min_date', 0)))
+            self._photos(photos, params, EXTRAS)
+        elif method == 'flickr.people.getPhotos':
+            self._photos(stream.recently_updated(), params, ())
+        else:
+            self._send(404, '')
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A local stand-in for Flickr, serving a photostream."""
+
+    daemon_threads = True
+
+    def __init__(self, photostream):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _Handler)
+
+        self.url = "http://127.0.0.1:%u" % self.server_address[1]
+
+        self.photostream = photostream
+        self.connections = set()
+
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def get_request(self):
+        conn, address = BaseHTTPServer.HTTPServer.get_request(self)
+        self.connections.add(conn)
+
+        return conn, address
+
+    def shutdown_request(self, request):
+        self.connections.discard(request)
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+        # Wake the handlers waiting on kept-alive connections.
+        for conn in list(self.connections):
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+class Proxy(object):
+    """A stand-in for the flickrapi proxy, talking to a Server."""
+
+    def __init__(self, url):
+        self.url = url
+
+    def _call(self, method, **kwargs):
+        kwargs['method'] = method
+
+        f = urllib2.urlopen(self.url + '/services/rest/',
+                            urllib.urlencode(kwargs))
+
+        return XML(f.read())
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        method = 'flickr.' + name.replace('_', '.')
+
+        return lambda **kwargs: self._call(method, **kwargs)
+
+    def upload(self, filename, callback=None):
+        with open(filename, 'rb') as f:
+            data = f.read()
+
+        return XML(urllib2.urlopen(self.url + '/upload', data).read())
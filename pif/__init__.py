@@ -2,11 +2,14 @@ __all__ = [
     'flickr',
     'hash',
     'local',
+    'stats',
     'ui',
     'workers',
 ]
 
 import hashlib
+import struct
+import weakref
 
 TAILHASH_SIZE = 512
 
@@ -18,14 +21,93 @@ FORMATS = {
 }
 
 
+class Shorthash(object):
+    """A shorthash, kept as its raw digest and packed integers.
+
+    Equal shorthashes are interned. A shorthash hashes and compares equal to
+    its string form, which is how it's stored, so either finds the other in
+    a dictionary, but the indexes keep them as shorthashes, as formatting them
+    is slow."""
+
+    __slots__ = ('_data', 'format', '_hash', '__weakref__')
+
+    _INTEGERS = struct.Struct('>QII')  # size, height, width
+    _interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, digest, format, size, height, width):
+        data = digest + cls._INTEGERS.pack(size, height, width)
+        key = data, format
+
+        self = cls._interned.get(key)
+
+        if self is None:
+            self = object.__new__(cls)
+            self._data = data
+            self.format = intern(str(format))
+            # Not hash(), which is shadowed by pif.hash once it's imported.
+            self._hash = str(self).__hash__()
+
+            cls._interned[key] = self
+
+        return self
+
+    @classmethod
+    def parse(cls, value):
+        """Make a shorthash from its string form."""
+
+        digest, format, size, height, width = value.split(':')
+
+        return cls(digest.decode('hex'), format,
+                   int(size), int(height), int(width))
+
+    digest = property(lambda self: self._data[:-self._INTEGERS.size])
+
+    size = property(lambda self: self._integers()[0])
+    height = property(lambda self: self._integers()[1])
+    width = property(lambda self: self._integers()[2])
+
+    def _integers(self):
+        return self._INTEGERS.unpack(self._data[-self._INTEGERS.size:])
+
+    def __str__(self):
+        values = (self.digest.encode('hex'), self.format) + self._integers()
+
+        return ':'.join(map(str, values))
+
+    def __unicode__(self):
+        return unicode(str(self))
+
+    def __repr__(self):
+        return 'Shorthash.parse(%r)' % str(self)
+
+    def __reduce__(self):
+        return Shorthash, (self.digest, self.format) + self._integers()
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        elif isinstance(other, Shorthash):
+            return self._data == other._data and self.format == other.format
+        elif isinstance(other, basestring):
+            return str(self) == other
+
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+
+        return result if result is NotImplemented else not result
+
+
 def make_shorthash(tail, original_format, size, width, height):
     """Calculate a shorthash."""
 
     # Normalize the data.
-    tail = hashlib.sha512(tail).hexdigest()
+    tail = hashlib.sha512(tail).digest()
     original_format = FORMATS[original_format.lower()]
     size, height, width = map(int, (size, height, width))
 
-    values = tail, original_format, size, height, width
-
-    return ':'.join(map(str, values))
+    return Shorthash(tail, original_format, size, height, width)
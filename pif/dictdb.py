@@ -1,21 +1,48 @@
+import collections
 import json
 import os
 import os.path
 import shutil
+import sqlite3
 import tempfile
+import threading
 
+import pif
+import pif.stats
 
-class DictDB(dict):
-    """A persistant JSON dictionary."""
+
+class JSONStore(object):
+    """Whole-file JSON storage, rewritten on every commit."""
 
     def __init__(self, filename):
         self.filename = filename
+        self.data = {}
 
         if os.access(filename, os.R_OK):
             with open(filename) as f:
-                self.update(json.load(f))
+                self.data.update(json.load(f))
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key):
+        return self.data[key]
+
+    def keys(self):
+        return self.data.keys()
+
+    def iteritems(self):
+        return self.data.iteritems()
+
+    def commit(self, updates, deletes):
+        self.data.update(updates)
+
+        for k in deletes:
+            self.data.pop(k, None)
 
-    def sync(self):
         f = tempfile.NamedTemporaryFile(
             suffix=os.path.basename(self.filename),
             dir=os.path.dirname(self.filename),
@@ -23,9 +50,250 @@ class DictDB(dict):
 
         try:
             with f:
-                json.dump(self, f)
+                json.dump(self.data, f)
         except:
             os.remove(f.name)
             raise
 
         shutil.move(f.name, self.filename)    # atomic commit
+
+
+class SQLiteStore(object):
+    """Key-value storage in an SQLite table, read and written per key.
+
+    Keys are byte strings, such as file names, and are stored as they are.
+    Files in the old whole-file JSON format are migrated on open."""
+
+    MAGIC = 'SQLite format 3\x00'
+
+    loads = staticmethod(json.loads)
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.RLock()
+        self.db = None
+
+        if os.access(filename, os.R_OK):
+            with open(filename, 'rb') as f:
+                if f.read(len(self.MAGIC)) != self.MAGIC:
+                    self._migrate()
+
+            self._connect()
+
+    def _connect(self):
+        self.db = sqlite3.connect(self.filename, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute('CREATE TABLE IF NOT EXISTS dict ('
+                        'key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    def _migrate(self):
+        """Convert a JSON database into an SQLite one, in place."""
+
+        data = dict(JSONStore(self.filename).data)
+
+        f = tempfile.NamedTemporaryFile(
+            suffix=os.path.basename(self.filename),
+            dir=os.path.dirname(self.filename),
+            delete=False)
+        f.close()
+
+        try:
+            db = sqlite3.connect(f.name)
+            with db:
+                db.execute('CREATE TABLE dict ('
+                           'key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+                db.executemany('INSERT INTO dict VALUES (?, ?)',
+                               ((k, json.dumps(v))
+                                for k, v in data.iteritems()))
+            db.close()
+        except:
+            os.remove(f.name)
+            raise
+
+        shutil.move(f.name, self.filename)    # atomic commit
+
+    def _query(self, sql, *args):
+        if self.db is None:
+            return []
+
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def __contains__(self, key):
+        return bool(self._query('SELECT 1 FROM dict WHERE key = ?', key))
+
+    def __len__(self):
+        return self._query('SELECT COUNT(*) FROM dict')[0][0] \
+               if self.db else 0
+
+    def get(self, key):
+        rows = self._query('SELECT value FROM dict WHERE key = ?', key)
+
+        if not rows:
+            raise KeyError(key)
+
+        return self.loads(rows[0][0])
+
+    def keys(self):
+        return [k for k, in self._query('SELECT key FROM dict')]
+
+    def iteritems(self):
+        return ((k, self.loads(v))
+                for k, v in self._query('SELECT key, value FROM dict'))
+
+    def commit(self, updates, deletes):
+        if not (updates or deletes):
+            return
+
+        with self.lock:
+            if self.db is None:
+                self._connect()
+
+            with self.db:   # One transaction.
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO dict VALUES (?, ?)',
+                    ((k, json.dumps(v)) for k, v in updates.iteritems()))
+                self.db.executemany(
+                    'DELETE FROM dict WHERE key = ?',
+                    ((k, ) for k in deletes))
+
+
+class DictDB(collections.MutableMapping):
+    """A persistant dictionary.
+
+    Values are loaded from the store as they're used and only the changed keys
+    are written back on sync. Mutating a value in place doesn't mark it as
+    changed; assign it back instead."""
+
+    STORE = SQLiteStore
+
+    def __init__(self, filename, store=None):
+        self.filename = filename
+        self.store = (store or self.STORE)(filename)
+
+        self._cache = {}
+        self._changed = set()
+        self._deleted = set()
+
+    # Keys are stored as they are, unless a subclass stores them otherwise.
+
+    def _dump_key(self, key):
+        return key
+
+    def _load_key(self, key):
+        return key
+
+    def __getitem__(self, key):
+        try:
+            return self._cache[key]
+        except KeyError:
+            if key in self._deleted:
+                raise
+
+        with pif.stats.timer('dictdb.load'):
+            value = self._cache[key] = self.store.get(self._dump_key(key))
+
+        return value
+
+    def __setitem__(self, key, value):
+        self._cache[key] = value
+        self._changed.add(key)
+        self._deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+
+        self._cache.pop(key, None)
+        self._changed.discard(key)
+        self._deleted.add(key)
+
+    def __contains__(self, key):
+        if key in self._cache:
+            return True
+        elif key in self._deleted:
+            return False
+
+        return self._dump_key(key) in self.store
+
+    def __iter__(self):
+        cache = set(self._cache)
+
+        for k in map(self._load_key, self.store.keys()):
+            if k in cache:
+                cache.remove(k)
+                yield k
+            elif k not in self._deleted:
+                yield k
+
+        for k in cache:
+            yield k
+
+    def __len__(self):
+        if not (self._changed or self._deleted):
+            return len(self.store)
+
+        return sum(1 for k in self)
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+    def iteritems(self):
+        cache = self._cache.copy()
+
+        for k, v in self.store.iteritems():
+            k = self._load_key(k)
+
+            if k in cache:
+                yield k, cache.pop(k)
+            elif k not in self._deleted:
+                yield k, v
+
+        for k, v in cache.iteritems():
+            yield k, v
+
+    def itervalues(self):
+        for k, v in self.iteritems():
+            yield v
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def sync(self):
+        changed, deleted = self._changed, self._deleted
+        self._changed, self._deleted = set(), set()
+
+        try:
+            with pif.stats.timer('dictdb.sync'):
+                self.store.commit(
+                    dict((self._dump_key(k), self._cache[k]) for k in changed),
+                    map(self._dump_key, deleted))
+        except:
+            self._changed |= changed
+            self._deleted |= deleted
+            raise
+
+        pif.stats.count('dictdb.written', len(changed) + len(deleted))
+
+
+class ShorthashDB(DictDB):
+    """A persistant dictionary keyed by shorthashes.
+
+    The shorthashes are stored in their string form, but kept as Shorthash
+    objects, so looking them up never formats them. Keys which aren't
+    shorthashes are kept as they're stored."""
+
+    def _dump_key(self, key):
+        return str(key)
+
+    def _load_key(self, key):
+        try:
+            return pif.Shorthash.parse(key)
+        except (TypeError, ValueError):
+            return key
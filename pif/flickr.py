@@ -1,24 +1,88 @@
+import collections
+import logging
+import os
+import os.path
+import time
+
+from multiprocessing.pool import ThreadPool
 from xml.parsers.expat import ExpatError
 
 import pkg_resources
 
 import flickrapi
+import flickrapi.tokencache
 
 from flickrapi.exceptions import FlickrError
 
 import pif.dictdb
+import pif.stats
 
 API_KEY, API_SECRET = pkg_resources.resource_string(
     __name__, 'flickr-api.key').split()
 
+AUTH_BUDGET = 2.0   # Seconds for an unattended authorization.
+
+LOG = logging.getLogger(__name__)
+
+
+class TokenCache(flickrapi.tokencache.TokenCache):
+    """An authorization token cache, kept in a directory of pif's own.
+
+    Tokens cached by earlier versions, in flickrapi's directory, are
+    adopted. Tokens are only readable by their owner."""
+
+    def __init__(self, api_key, directory):
+        flickrapi.tokencache.TokenCache.__init__(self, api_key)
+
+        self.legacy = flickrapi.tokencache.TokenCache(api_key)
+        self.path = directory
+
+    def get_cached_token(self):
+        token = flickrapi.tokencache.TokenCache.get_cached_token(self)
+
+        if token is None:
+            token = self.legacy.get_cached_token()
+
+            if token:
+                self.set_cached_token(token)
+
+        return token
+
+    def set_cached_token(self, token):
+        self.memory[self.username] = token
+
+        path = self.get_cached_token_path()
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        fd = os.open(self.get_cached_token_filename(),
+                     os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+
+        with os.fdopen(fd, 'w') as f:
+            f.write(token)
+
+    token = property(get_cached_token, set_cached_token,
+                     flickrapi.tokencache.TokenCache.forget)
+
+
+@pif.stats.timed('flickr.auth')
+def get_proxy(key=API_KEY, secret=API_SECRET, wait_callback=None,
+              token_dir=None):
+    """Get a web service proxy to Flickr.
 
-def get_proxy(key=API_KEY, secret=API_SECRET, wait_callback=None):
-    """Get a web service proxy to Flickr."""
+    A cached token is checked with a single call, skipping the authorization
+    by frob. The tokens are cached in token_dir, if given."""
+
+    start = time.time()
 
     # Setup the API proxy.
     perms = 'write'
     proxy = flickrapi.FlickrAPI(key, secret, format='etree')
 
+    if token_dir:
+        proxy.token_cache = TokenCache(key, token_dir)
+
     try:
         # Authorize.
         auth_response = proxy.get_token_part_one(perms=perms)
@@ -37,71 +101,221 @@ def get_proxy(key=API_KEY, secret=API_SECRET, wait_callback=None):
                 continue
             raise
 
+    # Only an unattended authorization, by cached token, has a budget.
+    elapsed = time.time() - start
+
+    if auth_response and auth_response[0] and elapsed > AUTH_BUDGET:
+        LOG.warn("Authorizing with Flickr took %.1fs.", elapsed)
+    else:
+        LOG.debug("Authorized with Flickr in %.1fs.", elapsed)
+
     return proxy
 
 
+class Photo(collections.namedtuple('Photo', (
+        'id',
+        'dateupload',
+        'lastupdate',
+        'originalformat',
+        'o_width',
+        'o_height',
+        'url_o',
+))):
+    """The metadata of a Flickr photo, as used by pif."""
+
+    __slots__ = ()
+
+    INTS = frozenset(('dateupload', 'lastupdate', 'o_width', 'o_height'))
+
+    @classmethod
+    def from_attrib(cls, attrib):
+        """Make a record from the attributes of a Flickr photo element."""
+
+        def _(field):
+            value = attrib.get(field)
+
+            if value is not None and field in cls.INTS:
+                return int(value)
+
+            return value
+
+        return cls(*map(_, cls._fields))
+
+
 class PhotoIndex(pif.dictdb.DictDB):
-    """A cache for Flickr photostream metadata."""
+    """A cache for Flickr photostream metadata.
+
+    The photos are stored as Photo records, which are kept on disk as lists.
+    Indexes of the photos' full attribute dicts are migrated on open."""
+
+    VERSION = 1
+    PER_PAGE = 500  # Photo IDs per reconciliation request.
+    THREADS = 4     # Concurrent page requests.
 
-    last_update = property(
-        lambda self: max([0, ] + [int(p['lastupdate'])
-                                  for p in self.itervalues()]))
+    last_update = property(lambda self: self.meta.get('last_update', 0))
 
     def __init__(self, proxy, filename):
         pif.dictdb.DictDB.__init__(self, filename)
 
         self.proxy = proxy
 
-    def _iter_recent(self, progress_callback=None):
-        """Get the recently updated photos."""
+        # The format version and the high-water mark of the last updates.
+        self.meta = pif.dictdb.DictDB(filename + '-meta')
 
-        page, pages = 1, 1
-
-        while page <= pages:
-            resp = self.proxy.photos_recentlyUpdated(
-                page=page,
-                min_date=self.last_update + 1,
-                extras=', '.join((
-                    'date_upload',
-                    'last_update',
-                    'o_dims',
-                    'original_format',
-                    'url_o',
-                ))
-            )
-
-            photos = resp.find('photos')
-
-            if photos:
-                for photo in photos.findall('photo'):
-                    yield photo.attrib
-            elif photos is None:
-                raise FlickrError('No photos in server response.')
-            else:
-                break
+        if self and self.meta.get('version', 0) < self.VERSION:
+            self.update(self.items())
+            self.meta['version'] = self.VERSION
+            self.sync()
+        elif not self:
+            self.meta['version'] = self.VERSION
+
+        if self and 'last_update' not in self.meta:
+            self.meta['last_update'] = max(
+                p.lastupdate or 0 for p in self.itervalues())
 
-            pages = int(photos.get('pages'))
+    def _load(self, photo):
+        if isinstance(photo, Photo):
+            return photo
+        elif isinstance(photo, dict):   # VERSION 0
+            return Photo.from_attrib(photo)
 
-            if progress_callback:
-                progress_callback('photos', (page, pages))
+        return Photo(*photo)
 
-            page = int(photos.get('page')) + 1
+    def __getitem__(self, photo_id):
+        photo = self._load(pif.dictdb.DictDB.__getitem__(self, photo_id))
+
+        self._cache[photo_id] = photo
+
+        return photo
+
+    def __setitem__(self, photo_id, photo):
+        pif.dictdb.DictDB.__setitem__(self, photo_id, photo)
+
+        if photo.lastupdate > self.last_update:
+            self.meta['last_update'] = photo.lastupdate
+
+    def iteritems(self):
+        for photo_id, photo in pif.dictdb.DictDB.iteritems(self):
+            yield photo_id, self._load(photo)
+
+    def _get_page(self, method, page, **kwargs):
+        """Get a page of photos from a Flickr method."""
+
+        with pif.stats.timer('flickr.api'):
+            resp = method(page=page, **kwargs)
+
+        photos = resp.find('photos')
+
+        if photos is None:
+            raise FlickrError('No photos in server response.')
+
+        return photos
+
+    def _iter_pages(self, method, state, progress_callback=None, **kwargs):
+        """Yield every page of photos from a Flickr method.
+
+        The first page gives the number of pages; the rest are requested
+        concurrently, but still yielded in order."""
+
+        photos = self._get_page(method, 1, **kwargs)
+
+        if not len(photos):
+            return
+
+        pages = int(photos.get('pages'))
+        pool = ThreadPool(max(1, min(self.THREADS, pages - 1)))
+
+        try:
+            responses = pool.imap(
+                lambda p: self._get_page(method, p, **kwargs),
+                xrange(2, pages + 1))
+
+            for page in xrange(1, pages + 1):
+                if page > 1:
+                    photos = responses.next()
+
+                    if not len(photos):
+                        break
+
+                yield photos
+
+                if progress_callback:
+                    progress_callback(state, (page, pages))
+        finally:
+            pool.terminate()
+
+    def _iter_recent(self, progress_callback=None):
+        """Get the recently updated photos."""
+
+        pages = self._iter_pages(
+            self.proxy.photos_recentlyUpdated,
+            'photos',
+            progress_callback,
+            min_date=self.last_update + 1,
+            extras=', '.join((
+                'date_upload',
+                'last_update',
+                'o_dims',
+                'original_format',
+                'url_o',
+            ))
+        )
+
+        for photos in pages:
+            for photo in photos.findall('photo'):
+                yield Photo.from_attrib(photo.attrib)
 
     def refresh(self, progress_callback=None):
         assert self.proxy, "Refresh with no proxy?"
 
-        # TODO: Detect deleted photos.
         recent_photos = list(self._iter_recent(progress_callback))
 
         # Only new or replaced photos count as updated.
         def _(new_p, old_p):
-            return not old_p or new_p['dateupload'] != old_p['dateupload']
+            return not old_p or new_p.dateupload != old_p.dateupload
 
-        updated_photos = [p['id']
+        updated_photos = [p.id
                           for p in recent_photos
-                          if _(p, self.get(p['id']))]
+                          if _(p, self.get(p.id))]
 
         # Update the index.
-        self.update(((p['id'], p) for p in recent_photos))
+        self.update(((p.id, p) for p in recent_photos))
 
         return updated_photos
+
+    def reconcile(self, progress_callback=None):
+        """Forget the photos deleted from Flickr, returning their IDs.
+
+        Only the IDs of the photostream are listed, through people.getPhotos,
+        as a search stops at a few thousand results. A listing that comes up
+        short of the reported total isn't trusted, as photos deleted while it
+        was paged through shift the others between pages."""
+
+        assert self.proxy, "Reconcile with no proxy?"
+
+        listed, total = set(), 0
+
+        for photos in self._iter_pages(self.proxy.people_getPhotos,
+                                       'reconcile',
+                                       progress_callback,
+                                       user_id='me',
+                                       per_page=self.PER_PAGE):
+            total = total or int(photos.get('total', 0))
+            listed.update(p.get('id') for p in photos.findall('photo'))
+
+        if len(listed) < total:
+            raise FlickrError("Incomplete photostream (%u of %u photos)." % (
+                len(listed), total))
+
+        deleted = [pid for pid in self if pid not in listed]
+
+        for pid in deleted:
+            del self[pid]
+
+        return deleted
+
+    def sync(self):
+        # The photos first, lest the high-water mark run ahead of them.
+        pif.dictdb.DictDB.sync(self)
+
+        self.meta.sync()
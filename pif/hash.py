@@ -1,26 +1,184 @@
+import collections
 import logging
+import StringIO
+import urllib
+import urlparse
+import eventlet.green.httplib as httplib
 import eventlet.green.urllib2 as urllib2
 
 import eventlet
+import eventlet.semaphore
 
 import pif
 import pif.dictdb
+import pif.stats
 
 from pif import TAILHASH_SIZE, make_shorthash
 
 LOG = logging.getLogger(__name__)
 
 
-class HashIndex(pif.dictdb.DictDB):
+class HTTPPool(object):
+    """Keep-alive HTTP connections, pooled by host."""
+
+    CONNECTIONS = {
+        'http': httplib.HTTPConnection,
+        'https': httplib.HTTPSConnection,
+    }
+
+    REDIRECTS = 5
+    REDIRECT_CODES = (301, 302, 303, 307)
+
+    def __init__(self, size, proxies=None):
+        self.size = size
+
+        # Proxied requests go through urllib2, which knows how to use them.
+        self.proxies = urllib.getproxies() if proxies is None else proxies
+        self.opener = urllib2.build_opener(urllib2.ProxyHandler(self.proxies))
+
+        self.idle = collections.defaultdict(list)
+        self.slots = collections.defaultdict(
+            lambda: eventlet.semaphore.Semaphore(self.size))
+
+    def _request(self, conn, request):
+        conn.request(request.get_method(),
+                     request.get_selector(),
+                     request.get_data(),
+                     dict(request.header_items()))
+
+        resp = conn.getresponse()
+
+        # Anything but a range, such as a whole photo from a server ignoring
+        # the Range, is left unread; its connection can't be reused.
+        if resp.status != httplib.PARTIAL_CONTENT \
+           and resp.status not in self.REDIRECT_CODES:
+            return resp, None
+
+        return resp, resp.read()
+
+    def _proxied(self, request):
+        return (request.get_type() in self.proxies and
+                not urllib.proxy_bypass(request.get_host()))
+
+    def urlopen(self, request):
+        """Open a urllib2 Request on a pooled connection.
+
+        Redirects are followed, through the pool of the host they lead to.
+        Returns a urllib2-style response, whose body has already been read,
+        unless it isn't a partial one, when it's left empty."""
+
+        for i in xrange(self.REDIRECTS + 1):
+            if self._proxied(request):
+                return self.opener.open(request)
+
+            f = self._urlopen(request)
+            location = f.headers.get('location')
+
+            if f.code not in self.REDIRECT_CODES or not location:
+                return f
+
+            request = urllib2.Request(urlparse.urljoin(f.url, location),
+                                      headers=dict(request.header_items()))
+
+        raise IOError("Too many redirects from %s" % f.url)
+
+    def _urlopen(self, request):
+        key = request.get_type(), request.get_host()
+
+        with self.slots[key]:
+            idle = self.idle[key]
+
+            while True:
+                reused = bool(idle)
+
+                if reused:
+                    conn = idle.pop()
+                else:
+                    conn = self.CONNECTIONS[key[0]](key[1])
+                    pif.stats.count('hash.connections')
+
+                pif.stats.count('hash.requests')
+
+                try:
+                    resp, body = self._request(conn, request)
+                except (httplib.HTTPException, IOError) as e:
+                    conn.close()
+
+                    # The server may have dropped an idle connection.
+                    if reused:
+                        continue
+                    elif isinstance(e, IOError):
+                        raise
+                    else:
+                        raise IOError(e)
+
+                break
+
+            if body is None or resp.will_close:
+                conn.close()
+            else:
+                idle.append(conn)
+
+        return urllib.addinfourl(StringIO.StringIO(body or ''),
+                                 resp.msg,
+                                 request.get_full_url(),
+                                 resp.status)
+
+
+class HashIndex(pif.dictdb.ShorthashDB):
     """Cache for photo shorthashes."""
 
+    CHECKPOINT = 500    # Shorthashes merged between syncs.
+    CONNECTIONS = 4     # Per Flickr farm.
     RETRIES = 3
     THREADS = 10
 
     def __init__(self, photos, filename):
-        pif.dictdb.DictDB.__init__(self, filename)
+        pif.dictdb.ShorthashDB.__init__(self, filename)
 
         self.photos = photos
+        self.http = HTTPPool(self.CONNECTIONS)
+
+        # Photos whose shorthashes are yet to be, or couldn't be, retrieved.
+        self.pending = pif.dictdb.DictDB(filename + '-pending')
+        self.failed = pif.dictdb.DictDB(filename + '-failed')
+
+        # The shorthash of each photo ID, in its string form.
+        self.inverted = pif.dictdb.DictDB(filename + '-inverted')
+
+        if self and not self.inverted:
+            for sh, pids in self.iteritems():
+                for pid in filter(None, pids):
+                    assert pid not in self.inverted
+                    self.inverted[pid] = str(sh)
+
+    def __setitem__(self, shorthash, photo_ids):
+        key = str(shorthash)
+
+        for pid in filter(None, self.get(shorthash, [])):
+            if pid not in photo_ids and self.inverted.get(pid) == key:
+                del self.inverted[pid]
+
+        for pid in filter(None, photo_ids):
+            self.inverted[pid] = key
+
+        pif.dictdb.ShorthashDB.__setitem__(self, shorthash, photo_ids)
+
+    def __delitem__(self, shorthash):
+        key = str(shorthash)
+
+        for pid in filter(None, self[shorthash]):
+            if self.inverted.get(pid) == key:
+                del self.inverted[pid]
+
+        pif.dictdb.ShorthashDB.__delitem__(self, shorthash)
+
+    def shorthash_for(self, photo_id):
+        """Get the shorthash of a Flickr photo, or None if it isn't indexed."""
+
+        key = self.inverted.get(photo_id)
+
+        return None if key is None else self._load_key(key)
 
     def _get_shorthash(self, photo_id):
         """Get a shorthash for a Flickr photo."""
@@ -28,75 +186,96 @@ class HashIndex(pif.dictdb.DictDB):
         photo = self.photos[photo_id]
 
         req = urllib2.Request(
-            url=photo['url_o'],
+            url=photo.url_o,
             headers={'Range': "bytes=-%u" % TAILHASH_SIZE},
         )
 
-        f = urllib2.urlopen(req)
+        with pif.stats.timer('hash.range'):
+            f = self.http.urlopen(req)
 
         if f.code != urllib2.httplib.PARTIAL_CONTENT:
             raise IOError("Got status %s from Flickr" % f.code)
 
+        tail = f.read()
+        pif.stats.count('hash.tail_bytes', len(tail))
+
         return photo_id, make_shorthash(
-            f.read(),
-            photo['originalformat'],
+            tail,
+            photo.originalformat,
             int(f.headers['content-range'].split('/')[-1]),
-            int(photo['o_width']),
-            int(photo['o_height']))
+            photo.o_width,
+            photo.o_height)
 
-    def _get_shorthashes(self, photo_ids, progress_callback):
-        """Get shorthashes for multiple Flickr photos."""
+    def _try_get_shorthash(self, photo_id):
+        """Get a shorthash for a Flickr photo, or the IOError getting it."""
 
-        shorthashes = {}
+        try:
+            return self._get_shorthash(photo_id)
+        except IOError as e:
+            return photo_id, e
+
+    def _get_shorthashes(self, photo_ids, progress_callback, checkpoint):
+        """Get shorthashes for multiple Flickr photos.
+
+        The shorthashes are handed to checkpoint in batches as they arrive.
+        Returns the errors for the photos which couldn't be retrieved."""
+
+        done, errors = 0, {}
+        remaining = photo_ids
 
         # Pool the retrieval of the photo shorthashes, retrying the process on
-        # aborted photos.
+        # failed photos.
 
         pool = eventlet.GreenPool(size=self.THREADS)
         for retry in xrange(self.RETRIES):
-            try:
-                for pid, result in pool.imap(self._get_shorthash,
-                                             photo_ids - set(shorthashes)):
-                    shorthashes[pid] = result
-
-                    if progress_callback:
-                        progress_callback(
-                            'hashes', (len(shorthashes), len(photo_ids)))
-            except IOError:
-                LOG.debug('Retry #%u for shorthash retrieval', retry + 1)
-
-            if len(shorthashes) == len(photo_ids):
-                break
+            if retry:
+                LOG.debug('Retry #%u for shorthash retrieval', retry)
+
+            batch, errors = {}, {}
 
-        if photo_ids - set(shorthashes):
-            raise IOError('Could not retrieve all shorthashes')
+            for pid, result in pool.imap(self._try_get_shorthash, remaining):
+                if isinstance(result, IOError):
+                    pif.stats.count('hash.errors')
+                    errors[pid] = result
+                    continue
+
+                batch[pid] = result
+                done += 1
+
+                if progress_callback:
+                    progress_callback('hashes', (done, len(photo_ids)))
+
+                if len(batch) >= self.CHECKPOINT:
+                    checkpoint(batch)
+                    batch = {}
+
+            if batch:
+                checkpoint(batch)
 
-        return shorthashes
+            remaining = set(errors)
 
+            if not remaining:
+                break
+
+        return errors
+
+    @pif.stats.timed('hash.merge')
     def _merge_shorthashes(self, photo_shorthashes):
         """Returns an update representing a merge of the passed shorthashes."""
 
-        # Invert the hash index to check for photo ID collisions.
-        inverted = {}
-        for sh, pids in self.iteritems():
-            for p in filter(None, pids):
-                assert p not in inverted
-                inverted[p] = sh
-
-        # Merge the new shorthashes.
         merged_shorthashes = set()
         for pid, sh in photo_shorthashes.iteritems():
             # If a photo ID is replaced, remove the original owning shorthash.
-            if pid in inverted:
-                sh_old = inverted[pid]
+            if pid in self.inverted:
+                sh_old = self.shorthash_for(pid)
 
                 if sh == sh_old:
                     continue
                 else:
-                    self[sh_old].remove(pid)
+                    self[sh_old] = [p for p in self[sh_old] if p != pid]
                     merged_shorthashes.add(sh_old)
 
-            self.setdefault(sh, []).append(pid)
+            self[sh] = self.get(sh, []) + [pid]
             merged_shorthashes.add(sh)
 
         return merged_shorthashes
@@ -104,8 +283,72 @@ class HashIndex(pif.dictdb.DictDB):
     def refresh(self, progress_callback=None):
         assert self.photos is not None, 'Refresh with no metadata?'
 
-        photo_ids = set(self.photos.refresh(progress_callback))
-        photo_shorthashes = self._get_shorthashes(photo_ids, progress_callback)
-        new_shorthashes = self._merge_shorthashes(photo_shorthashes)
+        # Record the updated photos before their metadata, so an interrupted
+        # refresh resumes with them. Failed photos are retried.
+        for pid in self.photos.refresh(progress_callback):
+            self.pending[pid] = True
+
+        self.pending.sync()
+        self.photos.sync()
+
+        photo_ids = set(self.pending) | set(self.failed)
+        new_shorthashes = set()
+
+        def _checkpoint(photo_shorthashes):
+            new_shorthashes.update(
+                self._merge_shorthashes(photo_shorthashes))
+
+            for pid in photo_shorthashes:
+                self.pending.pop(pid, None)
+                self.failed.pop(pid, None)
+
+            self.sync()
+
+        errors = self._get_shorthashes(photo_ids, progress_callback,
+                                       _checkpoint)
+
+        for pid, e in errors.iteritems():
+            LOG.warn("Couldn't retrieve the shorthash of photo %s: %s", pid, e)
+
+            self.pending.pop(pid, None)
+            self.failed[pid] = str(e)
+
+        self.sync()
 
         return list(new_shorthashes)
+
+    def reconcile(self, progress_callback=None):
+        """Forget the photos deleted from Flickr, returning their IDs."""
+
+        assert self.photos is not None, 'Reconcile with no metadata?'
+
+        deleted = self.photos.reconcile(progress_callback)
+
+        for pid in deleted:
+            self.pending.pop(pid, None)
+            self.failed.pop(pid, None)
+
+            sh = self.shorthash_for(pid)
+
+            if sh is None:
+                continue
+
+            photo_ids = [p for p in self.get(sh, []) if p != pid]
+
+            if photo_ids:
+                self[sh] = photo_ids
+            else:
+                del self[sh]
+
+        # Drop the shorthashes first, so an interruption leaves none behind.
+        self.sync()
+        self.photos.sync()
+
+        return deleted
+
+    def sync(self):
+        pif.dictdb.ShorthashDB.sync(self)
+
+        self.inverted.sync()
+        self.pending.sync()
+        self.failed.sync()
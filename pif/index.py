@@ -1,9 +1,19 @@
+import logging
 import os
 import os.path
+import Queue
+import threading
+import time
 
+from multiprocessing.pool import ThreadPool
+
+import pif.dictdb
 import pif.flickr
 import pif.hash
 import pif.local
+import pif.stats
+
+from pif.flickr import FlickrError
 
 try:
     import xdg.BaseDirectory
@@ -12,63 +22,311 @@ try:
 except ImportError:
     CONFIG_DIR = os.path.expanduser('~/.pif')
 
+LOG = logging.getLogger(__name__)
+
+
+class lazy(object):
+    """An attribute computed on its first use, even from several threads."""
+
+    def __init__(self, function):
+        self.function = function
+        self.lock = threading.RLock()
+
+        self.__doc__ = function.__doc__
+
+    def __get__(self, obj, type=None):
+        if obj is None:
+            return self
+
+        name = self.function.__name__
+
+        with self.lock:
+            if name not in obj.__dict__:
+                obj.__dict__[name] = self.function(obj)
+
+        return obj.__dict__[name]
+
 
 class Index:
-    """An mapping of local images to photos on Flickr."""
+    """An mapping of local images to photos on Flickr.
+
+    The proxy and the indexes are opened on their first use, so local work
+    never waits on Flickr. The shorthashes are refreshed when first used,
+    unless the last refresh is recent enough."""
+
+    RECONCILE_INTERVAL = 7 * 24 * 60 * 60   # Seconds between reconciles.
+    REFRESH_INTERVAL = 15 * 60              # Seconds between refreshes.
 
     def __init__(self,
                  proxy_callback=None,
                  progress_callback=None,
-                 config_dir=CONFIG_DIR):
+                 config_dir=CONFIG_DIR,
+                 refresh=True,
+                 strict=False):
         self.cb_progress = progress_callback
         self.cb_proxy = proxy_callback
         self.config_dir = config_dir
+        self.auto_refresh = refresh
+        self.strict = strict
+
+    def _path(self, name):
+        if not os.path.isdir(self.config_dir):
+            os.makedirs(self.config_dir)
 
-        self._init_proxy()
-        self._init_indexes()
+        return os.path.join(self.config_dir, name)
 
-    def _init_proxy(self):
+    @lazy
+    def proxy(self):
         if 'PIF_NO_REFRESH' in os.environ:
-            self.proxy = None
-        else:
-            self.proxy = pif.flickr.get_proxy(wait_callback=self.cb_proxy)
+            return None
 
-    def _init_indexes(self):
-        files_fn = os.path.join(self.config_dir, 'files.db')
-        photos_fn = os.path.join(self.config_dir, 'photos.db')
-        hashes_fn = os.path.join(self.config_dir, 'hashes.db')
+        return pif.flickr.get_proxy(wait_callback=self.cb_proxy,
+                                    token_dir=self.config_dir)
 
-        if not os.path.isdir(self.config_dir):
-            os.makedirs(self.config_dir)
+    @lazy
+    def dirs(self):
+        return pif.local.DirectoryIndex(self._path('dirs.db'))
+
+    @lazy
+    def files(self):
+        files = pif.local.FileIndex(self._path('files.db'))
+
+        if self.strict:
+            files.STRICT = True
+
+        return files
+
+    @lazy
+    def photos(self):
+        # The proxy is only connected for a refresh.
+        return pif.flickr.PhotoIndex(None, self._path('photos.db'))
+
+    @lazy
+    def hashes(self):
+        hashes = pif.hash.HashIndex(self.photos, self._path('hashes.db'))
+
+        if self.auto_refresh:
+            self._refresh(hashes)
+
+        return hashes
+
+    @lazy
+    def state(self):
+        return pif.dictdb.DictDB(self._path('state.db'))
+
+    def _refresh(self, hashes, force=False):
+        if 'PIF_NO_REFRESH' in os.environ:
+            return
+
+        last = self.state.get('refreshed', 0)
+
+        if not force and time.time() - last < self.REFRESH_INTERVAL:
+            return LOG.debug('Skipping the refresh from Flickr.')
+
+        self.photos.proxy = self.proxy
+        hashes.refresh(progress_callback=self.cb_progress)
+
+        # Synced along with the index.
+        self.state['refreshed'] = time.time()
+
+    @pif.stats.timed('index.refresh')
+    def refresh(self, force=False):
+        """Load the updates from Flickr, unless the last load is recent."""
+
+        self._refresh(self.hashes, force)
+
+    @pif.stats.timed('index.reconcile')
+    def reconcile(self, force=False):
+        """Forget the photos deleted from Flickr, once the interval is up."""
+
+        if 'PIF_NO_REFRESH' in os.environ:
+            return []
+
+        last = self.state.get('reconciled', 0)
+
+        if not force and time.time() - last < self.RECONCILE_INTERVAL:
+            return []
+
+        self.photos.proxy = self.proxy
+
+        try:
+            deleted = self.hashes.reconcile(progress_callback=self.cb_progress)
+        except FlickrError as e:
+            LOG.warn("Couldn't check for photos deleted from Flickr: %s", e)
+            return []
+
+        self.state['reconciled'] = time.time()
+        self.state.sync()
+
+        if deleted:
+            LOG.info("Forgot %u photos deleted from Flickr.", len(deleted))
 
-        self.files = pif.local.FileIndex(files_fn)
+        return deleted
 
-        self.photos = pif.flickr.PhotoIndex(self.proxy, photos_fn)
-        self.hashes = pif.hash.HashIndex(self.photos, hashes_fn)
+    def _type(self, shorthash):
+        if shorthash is None:
+            return 'invalid'
+        elif self.hashes.get(shorthash, []):
+            return 'old'
 
-        if 'PIF_NO_REFRESH' not in os.environ:
-            self.hashes.refresh(progress_callback=self.cb_progress)
+        return 'new'
 
     def type(self, filename):
         try:
-            if self.hashes.get(self.files[filename], []):
-                return 'old'
+            return self._type(self.files[filename])
         except KeyError:
             return 'invalid'
 
-        return 'new'
+    def classify(self, shorthashes):
+        """Yield (type, filename) pairs for (filename, shorthash) pairs."""
+
+        for fn, shorthash in shorthashes:
+            yield self._type(shorthash), fn
+
+    def types(self, filenames, workers=None):
+        """Yield (type, filename) pairs, hashing the files in parallel."""
+
+        return self.classify(self.files.hash_many(filenames, workers))
 
     def ignore(self, filename):
         h = self.files[filename]
 
         if None not in self.hashes.get(h, []):
-            self.hashes.setdefault(h, []).append(None)
+            self.hashes[h] = self.hashes.get(h, []) + [None]
 
+    def add(self, filename, photo_id):
+        """Record a file as uploaded to Flickr."""
+
+        h = self.files[filename]
+
+        if photo_id not in self.hashes.get(h, []):
+            self.hashes[h] = self.hashes.get(h, []) + [photo_id]
+
+    @pif.stats.timed('index.upload')
     def upload(self, filename, callback=None):
         self.files[filename]    # Ensure the file is valid.
         return self.proxy.upload(filename, callback=callback)
 
+    @pif.stats.timed('index.sync')
     def sync(self):
-        self.hashes.sync()
-        self.photos.sync()
-        self.files.sync()
+        for name in ('hashes', 'photos', 'files', 'dirs', 'state'):
+            if name in self.__dict__:   # Only those opened.
+                getattr(self, name).sync()
+
+
+class UploadScheduler(object):
+    """Upload files to Flickr concurrently, retrying failed uploads."""
+
+    BACKOFF = 2     # Seconds before the first retry, doubling thereafter.
+    RETRIES = 3
+    THREADS = 4
+
+    def __init__(self, index, callback=None, threads=None):
+        self.index = index
+        self.callback = callback
+        self.threads = threads or self.THREADS
+
+        self.lock = threading.Lock()
+        self.progress = {}
+        self.total = None
+
+    def _progress(self, filename, progress):
+        """Report the aggregate progress of the uploads."""
+
+        with self.lock:
+            self.progress[filename] = progress
+
+            total = self.total or len(self.progress)
+            progress = sum(self.progress.itervalues()) / total
+
+        if self.callback:
+            self.callback(progress, False)
+
+    def _upload(self, filename):
+        """Upload a file, returning its photo ID or None."""
+
+        def _(progress, done):
+            self._progress(filename, 100.0 if done else progress)
+
+        for retry in xrange(self.RETRIES):
+            if retry:
+                LOG.debug('Retry #%u for uploading %s', retry, filename)
+                time.sleep(self.BACKOFF * 2 ** (retry - 1))
+
+            try:
+                resp = self.index.upload(filename, callback=_)
+            except KeyError:
+                break       # The file is invalid; retrying won't help.
+            except (FlickrError, IOError):
+                LOG.debug('Upload of %s failed.', filename, exc_info=True)
+                continue
+
+            if resp is None:
+                LOG.debug('No response from the upload proxy.')
+                continue
+
+            photo_id = resp.find('photoid')
+
+            # Ugly because the photoid element is a boolean False.
+            if photo_id is not None:
+                return photo_id.text
+            else:
+                LOG.debug('No photo_id in the enclosed response.')
+
+        self._progress(filename, 100.0)
+
+    def _worker(self, filename):
+        """Upload a file in a worker thread, returning any error."""
+
+        try:
+            return filename, self._upload(filename), None
+        except Exception as e:
+            return filename, None, e
+
+    def _merge(self, filename, photo_id, error):
+        """Record the result from an upload worker."""
+
+        if error:
+            raise error
+        elif photo_id is not None:
+            self.index.add(filename, photo_id)
+
+            # Saved at once, so an interrupted run doesn't upload it again.
+            self.index.hashes.sync()
+
+        return filename, photo_id
+
+    def upload(self, filenames):
+        """Yield (filename, photo ID) pairs, uploading the files concurrently.
+
+        Results come in completion order, with a photo ID of None for the
+        uploads which failed. Uploaded files are recorded in the index, by the
+        caller's thread, as they complete."""
+
+        try:
+            self.total = len(filenames)
+        except TypeError:
+            self.total = None
+
+        pool = ThreadPool(self.threads)
+        done = Queue.Queue()
+        pending = 0
+
+        try:
+            for fn in filenames:
+                pool.apply_async(self._worker, (fn, ), callback=done.put)
+                pending += 1
+
+                while pending >= self.threads \
+                      or (pending and not done.empty()):
+                    pending -= 1
+                    yield self._merge(*done.get())
+
+            while pending:
+                pending -= 1
+                yield self._merge(*done.get())
+        finally:
+            pool.terminate()
+
+        if self.callback:
+            self.callback(100.0, True)
@@ -1,48 +1,69 @@
+import base64
+import collections
+import json
+import mmap
+import multiprocessing
 import os
+import os.path
+import Queue
 
 import PIL.Image
 
 import pif.dictdb
+import pif.stats
 
-from pif import TAILHASH_SIZE, make_shorthash
+from pif import TAILHASH_SIZE, Shorthash, make_shorthash
 
+def _read_tail(f):
+    """Read the last TAILHASH_SIZE bytes of an open file, or all of it."""
 
-class FileIndex(pif.dictdb.DictDB):
-    """Cache for local file shorthashes."""
+    try:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError):  # Empty, or can't be mapped.
+        try:
+            f.seek(-TAILHASH_SIZE, 2)
+        except IOError:
+            # Maybe the file doesn't have TAILHASH_SIZE bytes to spare...
+            f.seek(0)
 
-    def __init__(self, filename):
-        pif.dictdb.DictDB.__init__(self, filename)
+        return f.read(TAILHASH_SIZE)
 
-    def __getitem__(self, filename):
-        if filename in self:
-            last_modified, shorthash = pif.dictdb.DictDB.__getitem__(
-                self, filename)
-        else:
-            last_modified, shorthash = None, None
+    try:
+        return m[max(0, len(m) - TAILHASH_SIZE):]
+    finally:
+        m.close()
 
-        # Abort if the file hasn't been modified.
-        statinfo = os.stat(filename)
 
-        if last_modified == statinfo.st_mtime:
-            return shorthash
+@pif.stats.timed('local.hash')
+def _hash_file(filename, statinfo=None, strict=False):
+    """Calculate the (mtime, shorthash) of a file, or None if it's invalid.
+
+    The image format and dimensions come from its header alone, unless
+    strict, when the whole image is verified."""
+
+    with open(filename, 'rb') as f:
+        if statinfo is None:
+            statinfo = os.fstat(f.fileno())
 
         # Validate the potential image.
         try:
-            image = PIL.Image.open(filename)
-            image.verify()
-        except IOError:
-            raise KeyError(filename)
+            with pif.stats.timer('local.image'):
+                image = PIL.Image.open(f)
+
+                if strict:
+                    image.verify()
+        except (IOError, SyntaxError):  # PIL reports broken images either way.
+            pif.stats.count('local.invalid')
+            return None
 
         # Gather the metadata to create the shorthash.
-        with file(filename) as f:
-            try:
-                f.seek(-TAILHASH_SIZE, 2)
-            except IOError:
-                # Maybe the file doesn't have TAILHASH_SIZE bytes to spare...
-                f.seek(0)
+        with pif.stats.timer('local.tail'):
+            tailhash = _read_tail(f)
 
-            tailhash = f.read(TAILHASH_SIZE)
+    pif.stats.count('local.tail_bytes', len(tailhash))
 
+    # PIL opens formats which can't be on Flickr, such as a BMP named .jpg.
+    try:
         shorthash = make_shorthash(
             tailhash,
             image.format,
@@ -50,8 +71,430 @@ class FileIndex(pif.dictdb.DictDB):
             image.size[0],
             image.size[1],
         )
+    except (KeyError, IOError, ValueError):
+        pif.stats.count('local.invalid')
+        return None
 
-        # Cache the shorthash.
-        self[filename] = (statinfo.st_mtime, shorthash)
+    return statinfo.st_mtime, shorthash
+
+
+def _hash_worker(filename, statinfo=None, strict=False):
+    """Hash a file in a worker process, returning any error to the parent."""
+
+    try:
+        return filename, _hash_file(filename, statinfo, strict), None
+    except EnvironmentError:    # The file vanished or isn't readable.
+        return filename, None, None
+    except Exception as e:
+        return filename, None, e
+
+
+def _hash_pooled(filename, statinfo=None, strict=False):
+    """Hash a file in a pooled process, returning its stats too, if enabled."""
+
+    if not pif.stats.STATS.enabled:
+        return _hash_worker(filename, statinfo, strict), None
+
+    pif.stats.STATS.reset()
+    result = _hash_worker(filename, statinfo, strict)
+
+    return result, pif.stats.STATS.snapshot()
+
+
+def _pack_shorthash(shorthash):
+    """Pack a shorthash for storage, with its digest in base64."""
+
+    if not isinstance(shorthash, Shorthash):
+        shorthash = Shorthash.parse(shorthash)
+
+    return ':'.join(map(str, (
+        base64.b64encode(shorthash.digest),
+        shorthash.format,
+        shorthash.size,
+        shorthash.height,
+        shorthash.width,
+    )))
+
+
+def _unpack_shorthash(packed):
+    digest, format, size, height, width = packed.split(':')
+
+    return Shorthash(base64.b64decode(digest), format,
+                     int(size), int(height), int(width))
+
+
+def _utf8(value):
+    """Encode the strings in a value loaded from JSON as UTF-8."""
+
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif isinstance(value, list):
+        return map(_utf8, value)
+    elif isinstance(value, dict):
+        return dict((_utf8(k), _utf8(v)) for k, v in value.iteritems())
+
+    return value
+
+
+class _FilenameStore(pif.dictdb.SQLiteStore):
+    """Storage of file names, loaded as the byte strings they were listed as,
+    rather than as the unicode strings JSON gives."""
+
+    @staticmethod
+    def loads(value):
+        return _utf8(json.loads(value))
+
+
+class FileIndex(collections.MutableMapping):
+    """Cache for local file shorthashes.
+
+    The files are stored by directory, so their paths aren't repeated, with
+    packed shorthashes. Indexes of whole filenames are migrated on open."""
+
+    VERSION = 1
+
+    WORKERS = None  # Defaults to the number of CPUs.
+    BACKLOG = 4     # Files queued per worker.
+    STRICT = False  # Verify whole images, not just their headers.
+
+    def __init__(self, filename):
+        self.filename = filename
+
+        # The entries of each directory, by file name.
+        self.db = pif.dictdb.DictDB(filename, _FilenameStore)
+        self.meta = pif.dictdb.DictDB(filename + '-meta')
+
+        if self.meta.get('version', 0) < self.VERSION:
+            self._migrate()
+
+        # The filenames of each shorthash.
+        self.inverted = pif.dictdb.ShorthashDB(filename + '-inverted',
+                                               _FilenameStore)
+
+        if not self.inverted and self:
+            for fn, (last_modified, shorthash) in self.iteritems():
+                self._link(shorthash, fn)
+
+    def _migrate(self):
+        """Regroup an index of whole filenames by directory.
+
+        The entries of directories are told apart from those of files by
+        their values, in case the version was lost along with the sidecar."""
+
+        entries = [(fn, result) for fn, result in self.db.iteritems()
+                   if not isinstance(result, dict)]
+
+        for fn, result in entries:
+            del self.db[fn]
+
+        for fn, result in entries:
+            self._store(fn, result)
+
+        self.meta['version'] = self.VERSION
+
+        if self.db:
+            self.db.sync()
+            self.meta.sync()
+
+    def _entry(self, filename):
+        """Get the cached (mtime, shorthash) of a file, fresh or not."""
+
+        path, name = os.path.split(filename)
+        last_modified, packed = self.db[path][name]
+
+        return last_modified, _unpack_shorthash(packed)
+
+    def _store(self, filename, result):
+        path, name = os.path.split(filename)
+        last_modified, shorthash = result
+
+        entries = self.db.get(path) or {}
+        entries[name] = [last_modified, _pack_shorthash(shorthash)]
+
+        self.db[path] = entries     # Mark the directory as changed.
+
+    def _discard(self, filename):
+        path, name = os.path.split(filename)
+
+        entries = self.db[path]
+        del entries[name]
+
+        if entries:
+            self.db[path] = entries
+        else:
+            del self.db[path]
+
+    def _link(self, shorthash, filename):
+        filenames = self.inverted.get(shorthash, [])
+
+        if filename not in filenames:
+            self.inverted[shorthash] = filenames + [filename]
+
+    def _unlink(self, shorthash, filename):
+        filenames = [fn for fn in self.inverted.get(shorthash, [])
+                     if fn != filename]
+
+        if filenames:
+            self.inverted[shorthash] = filenames
+        else:
+            self.inverted.pop(shorthash, None)
+
+    def _shorthash(self, filename):
+        """Get the cached shorthash of a file, fresh or not."""
+
+        try:
+            return self._entry(filename)[1]
+        except KeyError:
+            return None
+
+    def __setitem__(self, filename, result):
+        old_shorthash = self._shorthash(filename)
+
+        self._store(filename, result)
+
+        if old_shorthash != result[1]:
+            if old_shorthash is not None:
+                self._unlink(old_shorthash, filename)
+
+            self._link(result[1], filename)
+
+    def __delitem__(self, filename):
+        shorthash = self._shorthash(filename)
+
+        if shorthash is None:
+            raise KeyError(filename)
+
+        self._discard(filename)
+        self._unlink(shorthash, filename)
+
+    def __contains__(self, filename):
+        path, name = os.path.split(filename)
+
+        return name in self.db.get(path, ())
+
+    def __iter__(self):
+        for path, entries in self.db.iteritems():
+            for name in entries:
+                yield os.path.join(path, name)
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.db.itervalues())
+
+    def __nonzero__(self):
+        # Directories without entries are deleted, so none are empty.
+        return bool(len(self.db))
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+    def iteritems(self):
+        """Iterate over the cached (mtime, shorthash) of the files."""
+
+        for path, entries in self.db.iteritems():
+            for name, (last_modified, packed) in entries.iteritems():
+                yield os.path.join(path, name), \
+                      (last_modified, _unpack_shorthash(packed))
+
+    def items(self):
+        return list(self.iteritems())
+
+    def itervalues(self):
+        for fn, result in self.iteritems():
+            yield result
+
+    def values(self):
+        return list(self.itervalues())
+
+    def filenames(self, shorthash):
+        """Get the filenames indexed with a shorthash."""
+
+        return list(self.inverted.get(shorthash, []))
+
+    def _cached(self, filename, statinfo=None):
+        """Get a cached shorthash, raising KeyError if it's missing or stale."""
+
+        try:
+            last_modified, shorthash = self._entry(filename)
+        except KeyError:
+            last_modified, shorthash = None, None
+
+        # Abort if the file hasn't been modified.
+        statinfo = statinfo or os.stat(filename)
+
+        if last_modified != statinfo.st_mtime:
+            raise KeyError(filename)
 
         return shorthash
+
+    def __getitem__(self, filename):
+        try:
+            return self._cached(filename)
+        except KeyError:
+            pass
+
+        result = _hash_file(filename, strict=self.STRICT)
+
+        if result is None:
+            raise KeyError(filename)
+
+        # Cache the shorthash.
+        self[filename] = result
+
+        return result[1]
+
+    def _merge(self, filename, result, error):
+        """Cache the result from a hashing worker."""
+
+        if error:
+            raise error
+        elif result is None:
+            return filename, None
+
+        self[filename] = result
+
+        return filename, result[1]
+
+    def hash_many(self, filenames, workers=None):
+        """Yield (filename, shorthash) pairs for many files.
+
+        The files may be given as filenames or as (filename, statinfo) pairs,
+        which saves a stat of each file whose cache entry is fresh. Stale files
+        are fanned out to a pool of worker processes and yielded in completion
+        order. Invalid files have a shorthash of None. The workers
+        never touch the index; all cache writes happen in the caller.
+
+        The pool is only started at the first stale file, so a rescan of
+        cached files forks nothing."""
+
+        workers = workers or self.WORKERS or multiprocessing.cpu_count()
+        pool = None
+
+        done = Queue.Queue()
+        pending = 0
+
+        def _done(result):
+            result, stats = result
+
+            if stats:
+                pif.stats.STATS.merge(stats)
+            done.put(result)
+
+        try:
+            for fn in filenames:
+                if isinstance(fn, basestring):
+                    statinfo = None
+                else:
+                    fn, statinfo = fn
+
+                try:
+                    shorthash = self._cached(fn, statinfo)
+                    pif.stats.count('local.cached')
+
+                    yield fn, shorthash
+                    continue
+                except KeyError:
+                    pass
+                except EnvironmentError:
+                    yield fn, None
+                    continue
+
+                if workers == 1:
+                    yield self._merge(*_hash_worker(fn, statinfo,
+                                                    self.STRICT))
+                    continue
+                elif pool is None:
+                    pool = multiprocessing.Pool(workers,
+                                                initializer=pif.stats.reinit)
+
+                pool.apply_async(_hash_pooled, (fn, statinfo, self.STRICT),
+                                 callback=_done)
+                pending += 1
+
+                # Only block on the workers when they're saturated.
+                while pending >= workers * self.BACKLOG \
+                      or (pending and not done.empty()):
+                    pending -= 1
+                    yield self._merge(*done.get())
+
+            while pending:
+                pending -= 1
+                yield self._merge(*done.get())
+        finally:
+            if pool:
+                pool.terminate()
+
+    def sync(self):
+        self.db.sync()
+        self.inverted.sync()
+        self.meta.sync()
+
+
+class DirectoryIndex(pif.dictdb.DictDB):
+    """Cache for the listings of image directories.
+
+    A directory whose mtime hasn't changed since it was last listed isn't
+    listed again; only its files are stat'ed, as they may be modified in place
+    without touching the directory."""
+
+    def __init__(self, filename):
+        pif.dictdb.DictDB.__init__(self, filename, _FilenameStore)
+
+    @pif.stats.timed('local.list')
+    def _list(self, path, match):
+        """List a directory, giving its subdirectories and matching files."""
+
+        dirs, files = [], []
+
+        for name in os.listdir(path):
+            fn = os.path.join(path, name)
+
+            if os.path.isdir(fn) and not os.path.islink(fn):
+                dirs.append(name)
+            elif match(name):
+                files.append(name)
+
+        return sorted(dirs), sorted(files)
+
+    def walk(self, top, match):
+        """Yield (filename, statinfo) pairs for matching files under top."""
+
+        stack = [os.path.abspath(top)]
+
+        while stack:
+            path = stack.pop()
+
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+
+            cached = self.get(path)
+
+            # Listings of (name, mtime, size) are from an older version.
+            if cached and cached[0] == mtime \
+               and all(isinstance(f, basestring) for f in cached[2]):
+                dirs, files = cached[1:]
+                pif.stats.count('local.dirs_cached')
+            else:
+                try:
+                    dirs, files = self._list(path, match)
+                except OSError:
+                    continue
+
+                # Forget the subdirectories that have gone.
+                for d in set(cached[1] if cached else []) - set(dirs):
+                    self.pop(os.path.join(path, d), None)
+
+                self[path] = (mtime, dirs, files)
+
+            for name in files:
+                fn = os.path.join(path, name)
+
+                try:
+                    statinfo = os.stat(fn)
+                except OSError:     # The file vanished.
+                    continue
+
+                yield fn, statinfo
+
+            stack.extend(os.path.join(path, d) for d in reversed(dirs))
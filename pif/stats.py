@@ -0,0 +1,182 @@
+import json
+import threading
+import time
+
+from decorator import decorator
+
+
+class _Timer(object):
+    """Time a with block as a call of a stage."""
+
+    __slots__ = ('stats', 'name', 'start')
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.stats.add(self.name, time.time() - self.start)
+
+
+class _NullTimer(object):
+    """Time nothing, while the stats are disabled."""
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Stats(object):
+    """Timings of the stages of a run, and counters of the work they did.
+
+    The timings of concurrent stages add up, so a stage may take longer
+    than the run. While disabled, as by default, recording is a no-op."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enabled = False
+
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start = time.time()
+
+            self.stages = {}    # name: [calls, seconds]
+            self.counters = {}  # name: total
+
+    def enable(self):
+        self.reset()
+        self.enabled = True
+
+    def add(self, name, seconds, calls=1):
+        """Record calls of a stage, taking seconds altogether."""
+
+        if not self.enabled:
+            return
+
+        with self.lock:
+            stage = self.stages.setdefault(name, [0, 0.0])
+            stage[0] += calls
+            stage[1] += seconds
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def timer(self, name):
+        """Get a context manager timing a call of a stage."""
+
+        return _Timer(self, name) if self.enabled else _NULL_TIMER
+
+    def snapshot(self):
+        """Get the stages and counters, so far, as plain data."""
+
+        with self.lock:
+            return {
+                'stages': dict((k, list(v))
+                               for k, v in self.stages.iteritems()),
+                'counters': dict(self.counters),
+            }
+
+    def merge(self, snapshot):
+        """Add a snapshot, such as one from a worker process."""
+
+        for name, (calls, seconds) in snapshot['stages'].iteritems():
+            self.add(name, seconds, calls)
+
+        for name, n in snapshot['counters'].iteritems():
+            self.count(name, n)
+
+    def report(self):
+        """Get the stages and counters, with their throughputs."""
+
+        elapsed = time.time() - self.start
+        snapshot = self.snapshot()
+
+        def _rate(n, seconds):
+            return n / seconds if seconds else None
+
+        return {
+            'elapsed': elapsed,
+            'stages': dict((k, {
+                'calls': calls,
+                'seconds': seconds,
+                'per_second': _rate(calls, seconds),
+            }) for k, (calls, seconds) in snapshot['stages'].iteritems()),
+            'counters': dict((k, {
+                'total': n,
+                'per_second': _rate(n, elapsed),
+            }) for k, n in snapshot['counters'].iteritems()),
+        }
+
+    def format(self):
+        """Get the report as a table."""
+
+        report = self.report()
+        lines = ["%-24s %10s %10s %12s" % (
+            'Stage', 'Calls', 'Seconds', 'Calls/s')]
+
+        for k, s in sorted(report['stages'].iteritems()):
+            lines.append("%-24s %10u %10.3f %12.1f" % (
+                k, s['calls'], s['seconds'], s['per_second'] or 0))
+
+        lines.append("%-24s %10s %10s %12s" % ('Counter', 'Total', '', 'Per s'))
+
+        for k, c in sorted(report['counters'].iteritems()):
+            lines.append("%-24s %10u %10s %12.1f" % (
+                k, c['total'], '', c['per_second'] or 0))
+
+        lines.append("%.3f seconds elapsed." % report['elapsed'])
+
+        return '\n'.join(lines)
+
+    def dump(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+
+
+# The stats of this process.
+STATS = Stats()
+
+
+def reinit():
+    """Start this process's stats over, as in a forked process.
+
+    Another thread may have held the lock of the parent's stats at the fork,
+    and it would never be released in the child."""
+
+    global STATS
+
+    enabled = STATS.enabled
+    STATS = Stats()
+    STATS.enabled = enabled
+
+
+def timer(name):
+    return STATS.timer(name)
+
+
+def count(name, n=1):
+    STATS.count(name, n)
+
+
+def timed(name):
+    """Time the calls of the decorated function as a stage."""
+
+    def _(func, *args, **kwargs):
+        with STATS.timer(name):
+            return func(*args, **kwargs)
+
+    return lambda function: decorator(_, function)
@@ -0,0 +1,74 @@
+import collections
+import threading
+
+
+class LRUCache(object):
+    """A mapping keeping its most recently used values, up to a total size.
+
+    Values are sized by a function. The least recently used are evicted once
+    the total exceeds the ceiling; a value that alone exceeds it isn't kept."""
+
+    OVERHEAD = 256  # Bytes per entry, besides its value.
+
+    def __init__(self, ceiling, sizeof=len):
+        self.ceiling = ceiling
+        self.sizeof = sizeof
+
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()    # key: (value, size)
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                entry = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self.entries[key] = entry   # Now the most recently used.
+            self.hits += 1
+
+        return entry[0]
+
+    def __setitem__(self, key, value):
+        size = self.sizeof(value) + self.OVERHEAD
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+
+            if old:
+                self.size -= old[1]
+
+            if size > self.ceiling:
+                return
+
+            self.entries[key] = value, size
+            self.size += size
+
+            while self.size > self.ceiling:
+                k, (v, s) = self.entries.popitem(last=False)
+                self.size -= s
+                self.evictions += 1
+
+    def counters(self):
+        """Get the hits, misses and evictions so far, and the current size."""
+
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
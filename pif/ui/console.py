@@ -1,6 +1,10 @@
 import logging
+import os.path
 import time
 
+import pif.index
+import pif.workers
+
 from pif.ui.shell import Shell
 
 
@@ -13,12 +17,25 @@ class ConsoleShell(Shell):
     def _init_option_parser(self):
         Shell._init_option_parser(self)
 
+        self.option_parser.add_option('-d', '--duplicates',
+                                      action='store_true',
+                                      help='report duplicate files and only '
+                                           'upload one of each')
         self.option_parser.add_option('-f', '--force', action='store_true',
                                       help='force file(s) to be uploaded')
         self.option_parser.add_option('-m', '--mark', action='store_true',
                                       help='mark file(s) as uploaded')
         self.option_parser.add_option('-n', '--dry-run', action='store_true',
                                       help='do not upload file(s)')
+        self.option_parser.add_option('--refresh', action='store_true',
+                                      help='load updates from Flickr, even '
+                                           'if recently loaded')
+        self.option_parser.add_option('-r', '--reconcile', action='store_true',
+                                      help='check now for photos deleted '
+                                           'from Flickr')
+        self.option_parser.add_option('--strict', action='store_true',
+                                      help='verify whole images, not just '
+                                           'their headers')
 
     def proxy_callback(self, proxy, perms, token, frob):
         LOG.info('Waiting for authorization from Flickr...')
@@ -30,19 +47,39 @@ class ConsoleShell(Shell):
         msgs = {
             'photos': 'Loading updates from Flickr...',
             'hashes': 'Indexing photos on Flickr...',
+            'reconcile': 'Checking for photos deleted from Flickr...',
         }
 
         a, b = meta
         LOG.info("%s (%u / %u)", msgs[state], *meta)
 
-    def run(self):
-        try:
-            index = self.make_index(self.proxy_callback,
-                                    self.progress_callback)
-        except IOError:
-            return LOG.critical("Couldn't connect to Flickr.")
+    def _unique(self, index, shorthashes):
+        """Yield one of each duplicate file, reporting the rest."""
+
+        seen = {}
+
+        for fn, shorthash in shorthashes:
+            if shorthash is None:
+                yield fn, shorthash
+                continue
+            elif shorthash in seen:
+                LOG.info("%s duplicates %s, skipping", fn, seen[shorthash])
+                continue
 
-        for t, fn in ((index.type(fn), fn) for fn in self.filenames):
+            seen[shorthash] = fn
+
+            others = [f for f in index.files.filenames(shorthash)
+                      if f != fn and os.path.exists(f)]
+
+            if others:
+                LOG.info("%s is duplicated by %s", fn, ', '.join(others))
+
+            yield fn, shorthash
+
+    def _uploads(self, index, types):
+        """Yield the filenames to be uploaded, handling the rest."""
+
+        for t, fn in types:
             assert t in ('invalid', 'new', 'old')
 
             if t == 'new' or (t == 'old' and self.options.force):
@@ -57,15 +94,7 @@ class ConsoleShell(Shell):
 
                         LOG.info("%s marked as already uploaded", fn)
                     else:
-
-                        def _(progress, done):
-                            if done:
-                                LOG.info("Uploaded %s", fn)
-                            else:
-                                LOG.debug("Uploading %s... (%s%%)",
-                                          fn, int(progress))
-
-                        index.upload(fn, callback=_)
+                        yield fn
             elif t == 'old':
                 LOG.info(
                     "%s already uploaded, skipping (use --force to upload)",
@@ -73,6 +102,46 @@ class ConsoleShell(Shell):
             elif t == 'invalid':
                 LOG.warn("%s is invalid, skipping", fn)
 
+    def _refresh(self, index):
+        index.refresh(force=self.options.refresh)
+        index.reconcile(force=self.options.reconcile)
+
+    def run(self):
+        index = self.make_index(self.proxy_callback,
+                                self.progress_callback,
+                                refresh=False,
+                                strict=self.options.strict)
+
+        # Scan and hash the local files while Flickr is being refreshed; each
+        # stage runs in its own thread. Nothing consumes the shorthashes until
+        # the refresh is done, so they're buffered without bound.
+        refresh = pif.workers.Worker(self._refresh, index)
+
+        shorthashes = pif.workers.pipe(
+            index.files.hash_many(pif.workers.pipe(self.scan(index))),
+            size=0)
+
+        if self.options.duplicates:
+            shorthashes = self._unique(index, shorthashes)
+
+        try:
+            refresh.wait()
+        except IOError:
+            return LOG.critical("Couldn't connect to Flickr.")
+
+        def _(progress, done):
+            if not done:
+                LOG.debug("Uploading... (%s%%)", int(progress))
+
+        scheduler = pif.index.UploadScheduler(index, callback=_)
+        types = pif.workers.pipe(index.classify(shorthashes))
+
+        for fn, photo_id in scheduler.upload(self._uploads(index, types)):
+            if photo_id:
+                LOG.info("Uploaded %s", fn)
+            else:
+                LOG.error("Couldn't upload %s", fn)
+
         index.sync()
 
 
@@ -1,10 +1,13 @@
+import atexit
 import logging
 import optparse
 import os
 import os.path
 import re
+import sys
 
 import pif.index
+import pif.stats
 
 
 LOG = logging.getLogger(__name__)
@@ -24,6 +27,7 @@ class Shell(object):
             args=args)
 
         self._init_logging()
+        self._init_stats()
 
     def _init_option_parser(self):
         self.option_parser = optparse.OptionParser(
@@ -31,6 +35,12 @@ class Shell(object):
 
         self.option_parser.add_option('-v', '--verbose', action='store_true',
                                        help='increase verbosity')
+        self.option_parser.add_option('--stats', action='store_true',
+                                      help='report the time spent in each '
+                                           'stage on exit')
+        self.option_parser.add_option('--stats-json', metavar='FILE',
+                                      help='write the stage report to FILE, '
+                                           'as JSON')
 
     def _init_logging(self):
         if 'DEBUG' in os.environ:
@@ -40,6 +50,18 @@ class Shell(object):
         else:
             logging.root.setLevel(logging.WARN)
 
+    def _init_stats(self):
+        if self.options.stats or self.options.stats_json:
+            pif.stats.STATS.enable()
+            atexit.register(self._report_stats)
+
+    def _report_stats(self):
+        if self.options.stats:
+            print >> sys.stderr, pif.stats.STATS.format()
+
+        if self.options.stats_json:
+            pif.stats.STATS.dump(self.options.stats_json)
+
     def make_index(self, *args, **kwargs):
         return pif.index.Index(*args, **kwargs)
 
@@ -54,3 +76,17 @@ class Shell(object):
                         yield os.path.abspath(os.path.join(root, fn))
             else:
                 LOG.warn("%s is not a file or a directory.", fn)
+
+    def scan(self, index):
+        """Yield (filename, statinfo) pairs, using the index's directory cache.
+
+        The statinfo is None for files named directly."""
+
+        for fn in self.remain_args:
+            if os.path.isfile(fn):
+                yield os.path.abspath(fn), None
+            elif os.path.isdir(fn):
+                for entry in index.dirs.walk(fn, self.RE_IMAGES.match):
+                    yield entry
+            else:
+                LOG.warn("%s is not a file or a directory.", fn)
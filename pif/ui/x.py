@@ -1,9 +1,9 @@
-import collections
+import itertools
 import logging
 import os
 import Queue
-import sys
 import threading
+import time
 
 import pkg_resources
 
@@ -17,43 +17,66 @@ import gobject
 import gtk
 import gtk.glade
 
+import pif.workers
+
+from pif.ui.cache import LRUCache
 from pif.ui.shell import Shell
-from pif.flickr import FlickrError
+from pif.index import UploadScheduler
 
 LOG = logging.getLogger(__name__)
 
 
+def idle(function, *args, **kwargs):
+    """Call a function once, from the GObject mainloop."""
+
+    def _():
+        function(*args, **kwargs)
+        return False
+
+    gobject.idle_add(_)
+
+
 def thunk(function):
     """Enqueue the method-call into the GObject mainloop."""
 
     def _(func, *args, **kwargs):
-        gobject.idle_add(lambda: func(*args, **kwargs))
+        idle(func, *args, **kwargs)
 
     return decorator(_, function)
 
 
-def thread(function):
-    """Spawn a thread for the method-call."""
+# The worker threads of the UI, by activity. The calls of an activity wait for
+# a thread of its own, and their futures call back in the mainloop.
+EXECUTOR = pif.workers.Executor({'thumbnails': 4}, dispatch=idle)
+
+
+def thread(queue):
+    """Run the method-call on a queue of the executor, returning its future.
+
+    Its exception, if any, is raised in the GObject mainloop."""
+
+    def _raise(future):
+        try:
+            if not future.cancelled():
+                future.result()
+        except SystemExit:
+            pass
 
     def _worker(func, *args, **kwargs):
-        def _wrapper():
-            try:
-                func(*args, **kwargs)
-            except SystemExit:
-                raise
-            except:
-                def _(exc_info):
-                    type, value, traceback = exc_info
-                    raise type, value, traceback
-                thunk(_)(sys.exc_info())
-
-        t = threading.Thread(target=_wrapper)
-        t.setDaemon(True)
-        t.start()
+        future = EXECUTOR.submit(queue, func, *args, **kwargs)
+        future.add_done_callback(_raise)
+
+        return future
+
+    return lambda function: decorator(_worker, function)
 
-        return t
 
-    return decorator(_worker, function)
+def display_name(uri):
+    """Get the name of a file for display, querying gio synchronously."""
+
+    return gio.File(uri) \
+              .query_info(gio.FILE_ATTRIBUTE_STANDARD_DISPLAY_NAME) \
+              .get_display_name()
 
 
 class FolderScanDialog(gtk.FileChooserDialog):
@@ -245,21 +268,19 @@ class PreviewWindow(gobject.GObject):
         dest_store = dest_view.get_model()
         source_store = source_view.get_model()
 
-        # Use TreeRowReferences to maintain reference intergrity.
         selected = source_view.get_selected_items()
-        refs = [gtk.TreeRowReference(source_store, p) for p in selected]
+
+        if not selected:
+            return
 
         # Save the selection path.
         saved_p = min(selected)
 
-        for r in reversed(refs):
-            p = r.get_path()
-
-            dest_store.add(source_store[p].uri)
-            del source_store[p]
+        dest_store.append_images(source_store.take(selected))
 
         # Restore the selection path.
-        source_view.select_path(saved_p)
+        if saved_p[0] < len(source_store):
+            source_view.select_path(saved_p)
 
     def on_item_activated(self, view, path):
         """Open selected items in a view."""
@@ -303,97 +324,386 @@ class PreviewWindow(gobject.GObject):
         return self.emit('upload')
 
 
-class ImageStore(gtk.ListStore):
+class Image(object):
+    """A scanned image, shown in a row of one store at a time."""
+
+    __slots__ = ('uri', 'basename', 'store', 'index', 'job')
+
+    def __init__(self, uri, basename):
+        self.uri = uri
+        self.basename = basename
+
+        self.store = None
+        self.index = None
+
+        self.job = ThumbnailJob(self)
+
+
+class ThumbnailJob(object):
+    """An image to thumbnail."""
+
+    __slots__ = ('image', 'order', 'done', 'key')
+
+    def __init__(self, image):
+        self.image = image
+
+        self.order = None   # (priority, -generation) it's queued at.
+        self.done = False
+        self.key = None     # Of its thumbnail in the cache, once shown.
+
+
+class Thumbnailer(object):
+    """A pool of threads thumbnailing images, the visible ones first.
+
+    The thumbnails are handed to the mainloop in batches, by a single idle
+    callback. A job follows its image from store to store.
+
+    The thumbnails are cached in memory up to a size; past it, they're
+    looked up again in the thumbnail directory. The rows only hold the keys
+    of their thumbnails, so the cache bounds them all."""
+
+    CACHE_SIZE = 64 * 2 ** 20  # Bytes of pixbufs.
+
+    STOP, VISIBLE, QUEUED = -1, 0, 1    # Priorities, most urgent first.
+
+    MISSING = object()
+
+    def __init__(self, cache_size=None):
+        self.queue = Queue.PriorityQueue()
+        self.sequence = itertools.count()   # FIFO within a priority.
+        self.generation = 0                 # Of the rows in view.
+        self.cache = LRUCache(cache_size or self.CACHE_SIZE,
+                              self._pixbuf_size)
+
+        self.lock = threading.Lock()
+        self.thumbnails = []
+        self.flushing = False
+
+        self.threads = EXECUTOR.threads['thumbnails']
+
+        for i in xrange(self.threads):
+            self._thumbnail_wt()
+
+    def put(self, job, priority=QUEUED):
+        """Queue a job, or move it ahead if it's already queued.
+
+        Visible jobs are taken latest view first, so the rows in view don't
+        wait behind those scrolled past."""
+
+        generation = self.generation if priority == self.VISIBLE else 0
+        order = priority, -generation
+
+        if job.done:
+            return
+        elif job.order is None or order < job.order:
+            job.order = order
+            self.queue.put(order + (next(self.sequence), job))
+
+    def show(self, jobs):
+        """Queue the jobs of the rows in view ahead of all the others."""
+
+        self.generation += 1
+
+        for job in jobs:
+            self.put(job, self.VISIBLE)
+
+    @staticmethod
+    def _pixbuf_size(pixbuf):
+        if pixbuf is None:
+            return 0
+
+        return pixbuf.get_rowstride() * pixbuf.get_height()
+
+    def _thumbnail(self, thumber, uri):
+        mime = gio.content_type_guess(uri)
+        mtime = int(gio.File(uri) \
+                    .query_info(gio.FILE_ATTRIBUTE_TIME_MODIFIED) \
+                    .get_modification_time())
+
+        key = uri, mtime
+        t = self.cache.get(key, self.MISSING)
+
+        if t is not self.MISSING:
+            return key, t
+
+        t_uri = thumber.lookup(uri, mtime)
+        t = None
+
+        if t_uri:
+            t = gtk.gdk.pixbuf_new_from_file(t_uri)
+        elif thumber.can_thumbnail(uri, mime, mtime):
+            t = thumber.generate_thumbnail(uri, mime)
+            if t != None:
+                thumber.save_thumbnail(t, uri, mtime)
+
+        self.cache[key] = t
+
+        return key, t
+
+    def lookup(self, job):
+        """Get the thumbnail of a job, or None if it isn't done.
+
+        A thumbnail evicted from the cache is queued to be done again."""
+
+        if job.key is None:
+            return None
+
+        t = self.cache.get(job.key, self.MISSING)
+
+        if t is self.MISSING:
+            job.key, job.order, job.done = None, None, False
+            self.put(job, self.VISIBLE)
+
+            return None
+
+        return t
+
+    def close(self):
+        """Stop the threads, dropping the queued jobs."""
+
+        for i in xrange(self.threads):
+            self.queue.put((self.STOP, 0, next(self.sequence), None))
+
+    @thread('thumbnails')
+    def _thumbnail_wt(self):
+        thumber = gnome.ui.ThumbnailFactory(gnome.ui.THUMBNAIL_SIZE_NORMAL)
+
+        while True:
+            job = self.queue.get()[-1]
+
+            if job is None:
+                return
+
+            # Taken already, from further ahead in the queue.
+            if job.done:
+                continue
+
+            job.done = True
+            key, t = self._thumbnail(thumber, job.image.uri)
+
+            if t != None:
+                self._done(job, key)
+
+    def _done(self, job, key):
+        with self.lock:
+            self.thumbnails.append((job, key))
+
+            if self.flushing:
+                return
+
+            self.flushing = True
+
+        gobject.idle_add(self._flush)
+
+    def _flush(self):
+        """Update the images with the thumbnails done since the last flush."""
+
+        with self.lock:
+            thumbnails, self.thumbnails = self.thumbnails, []
+            self.flushing = False
+
+        for job, key in thumbnails:
+            image = job.image
+            job.key = key
+
+            if image.store:
+                image.store.changed(image)
+
+        return False
+
+
+class ImageStore(gtk.GenericTreeModel):
+    """A list of images, as a lazy model for an IconView.
+
+    The rows are the images themselves; their values are only looked up as
+    they're shown. Images move between stores whole, with their thumbnail
+    jobs; the thumbnails are looked up in the thumbnailer's cache."""
+
     PIXBUF_UNKNOWN = gtk.gdk.pixbuf_new_from_file_at_scale(
         gtk.icon_theme_get_default().lookup_icon('image-loading',
                                                  gtk.ICON_SIZE_DIALOG, 0).get_filename(),
         -1, 128,
         True)
 
-    Image = collections.namedtuple('Image', 'uri basename pixbuf')
+    COLUMNS = (
+        gobject.TYPE_STRING,    # URI
+        gobject.TYPE_STRING,    # Basename
+        gtk.gdk.Pixbuf,         # Image
+    )
 
-    __thumbnail_queue__ = Queue.Queue()
-    __thumbnail_cache__ = {}
-    __thumbnail_thread__ = None
+    __thumbnailer__ = None
 
     def __init__(self, view_widget):
-        gtk.ListStore.__init__(
-            self,
-            gobject.TYPE_STRING,    # URI
-            gobject.TYPE_STRING,    # Basename
-            gtk.gdk.Pixbuf,         # Image
-        )
+        gtk.GenericTreeModel.__init__(self)
+
+        # The images keep themselves alive as the rows' references.
+        self.props.leak_references = False
+        self.images = []
+        self.visible = []
 
         # Start the thumbnailer.
-        if not type(self).__thumbnail_thread__:
-            type(self).__thumbnail_thread__ = self._thumbnail_wt()
+        if not type(self).__thumbnailer__:
+            type(self).__thumbnailer__ = Thumbnailer()
 
         # Attach the view to the store.
+        self.view = view_widget
         view_widget.props.can_focus = True
         view_widget.props.pixbuf_column = 2
         view_widget.props.text_column = 1
         view_widget.set_model(self)
 
-    def __getitem__(self, key):
-        return self.Image(*gtk.ListStore.__getitem__(self, key))
+        # Thumbnail the rows scrolled into view first.
+        scrolled = view_widget.get_parent()
+
+        if isinstance(scrolled, gtk.ScrolledWindow):
+            adjustment = scrolled.get_vadjustment()
+            adjustment.connect('value-changed', self.on_scroll)
+            adjustment.connect('changed', self.on_scroll)
+
+    def __getitem__(self, path):
+        return self.images[path[0]]
 
     def __iter__(self):
-        return (self.Image(*v) for v in gtk.ListStore.__iter__(self))
+        return iter(self.images)
 
-    @thread
-    def _thumbnail_wt(self):
-        thumber = gnome.ui.ThumbnailFactory(gnome.ui.THUMBNAIL_SIZE_NORMAL)
+    def __len__(self):
+        return len(self.images)
 
-        while True:
-            uri, ref = type(self).__thumbnail_queue__.get()
+    def _index(self, image):
+        # Only stale while rows are being taken.
+        i = image.index
 
-            mime = gio.content_type_guess(uri)
-            mtime = int(gio.File(uri) \
-                        .query_info(gio.FILE_ATTRIBUTE_TIME_MODIFIED) \
-                        .get_modification_time())
+        if i < len(self.images) and self.images[i] is image:
+            return i
 
-            if (uri, mtime) in type(self).__thumbnail_cache__:
-                t = type(self).__thumbnail_cache__[(uri, mtime)]
-            else:
-                t_uri = thumber.lookup(uri, mtime)
+        return self.images.index(image)
 
-                if t_uri:
-                    t = gtk.gdk.pixbuf_new_from_file(t_uri)
-                elif thumber.can_thumbnail(uri, mime, mtime):
-                    t = thumber.generate_thumbnail(uri, mime)
-                    if t != None:
-                        thumber.save_thumbnail(t, uri, mtime)
+    # The GenericTreeModel interface, with images as the row references.
 
-                type(self).__thumbnail_cache__[(uri, mtime)] = t
+    def on_get_flags(self):
+        return gtk.TREE_MODEL_LIST_ONLY
 
-            if t != None:
-                self._new_thumbnail(ref, t)
+    def on_get_n_columns(self):
+        return len(self.COLUMNS)
 
-    @thunk
-    def _new_thumbnail(self, ref, thumbnail):
-        p = ref.get_path()
-        store = ref.get_model()
+    def on_get_column_type(self, n):
+        return self.COLUMNS[n]
+
+    def on_get_iter(self, path):
+        if path[0] < len(self.images):
+            return self.images[path[0]]
+
+    def on_get_path(self, image):
+        return (self._index(image), )
+
+    def on_get_value(self, image, column):
+        if column == 0:
+            return image.uri
+        elif column == 1:
+            return image.basename
+        else:
+            return self.__thumbnailer__.lookup(image.job) or \
+                   self.PIXBUF_UNKNOWN
+
+    def on_iter_next(self, image):
+        i = self._index(image) + 1
+
+        if i < len(self.images):
+            return self.images[i]
+
+    def on_iter_children(self, image):
+        if image is None and self.images:
+            return self.images[0]
+
+    def on_iter_has_child(self, image):
+        return False
 
-        if p and store:
-            store[p] = store[p]._replace(pixbuf=thumbnail)
+    def on_iter_n_children(self, image):
+        return len(self.images) if image is None else 0
 
-    def add(self, uri):
-        i = self.Image(uri=uri,
-                       basename=gio.File(uri) \
-                                .query_info(gio.FILE_ATTRIBUTE_STANDARD_DISPLAY_NAME) \
-                                .get_display_name(),
-                       pixbuf=self.PIXBUF_UNKNOWN)
-        iter = self.append(i)
+    def on_iter_nth_child(self, image, n):
+        if image is None and n < len(self.images):
+            return self.images[n]
 
-        # Queue the image to be thumbnailed.
-        ref = gtk.TreeRowReference(self, self.get_path(iter))
-        type(self).__thumbnail_queue__.put_nowait((uri, ref))
+    def on_iter_parent(self, image):
+        return None
+
+    def changed(self, image):
+        """Signal a change to an image's row."""
+
+        path = (self._index(image), )
+        self.row_changed(path, self.get_iter(path))
+
+    def on_scroll(self, adjustment):
+        visible = self.view.get_visible_range()
+
+        if not visible:
+            return
+
+        start, end = visible
+        images = self.images[start[0]:end[0] + 1]
+
+        # Scrolling signals many times over the same rows.
+        if images != self.visible:
+            self.visible = images
+            self.__thumbnailer__.show(image.job for image in images)
+
+    def append_images(self, images):
+        """Append images, queueing those not yet thumbnailed."""
+
+        for image in images:
+            image.store = self
+            image.index = len(self.images)
+            self.images.append(image)
+
+            path = (image.index, )
+            self.row_inserted(path, self.get_iter(path))
+
+            self.__thumbnailer__.put(image.job)
+
+    def take(self, paths):
+        """Remove the rows at the paths, returning their images in order."""
+
+        indices = sorted(set(p[0] for p in paths))
+        images = [self.images[i] for i in indices]
+
+        for i in reversed(indices):
+            del self.images[i]
+            self.row_deleted((i, ))
+
+        for i in xrange(indices[0] if indices else 0, len(self.images)):
+            self.images[i].index = i
+
+        for image in images:
+            image.store = None
+
+        return images
+
+    def extend(self, images):
+        """Add (URI, basename) pairs, with the view detached meanwhile."""
+
+        self.view.set_model(None)
+
+        try:
+            self.append_images(Image(uri, basename)
+                               for uri, basename in images)
+        finally:
+            self.view.set_model(self)
+
+        self.on_scroll(None)
 
 
 class GTKShell(Shell):
+    SCAN_BATCH = 500        # New images added to the store at once.
+    SCAN_INTERVAL = 0.25    # Seconds at most between additions.
+
     def __init__(self):
         Shell.__init__(self)
 
+        # Shared by the stores.
+        ImageStore.__thumbnailer__ = Thumbnailer(
+            cache_size=self.options.thumbnail_cache * 2 ** 20)
+
         self.preview_window = PreviewWindow()
         self.preview_window.connect('upload', self.on_upload)
         self.preview_window.connect('close', self.on_close)
@@ -406,6 +716,14 @@ class GTKShell(Shell):
 
         self.index = None
 
+    def _init_option_parser(self):
+        Shell._init_option_parser(self)
+
+        self.option_parser.add_option(
+            '--thumbnail-cache', type='int', metavar='MB',
+            default=Thumbnailer.CACHE_SIZE // 2 ** 20,
+            help='memory for thumbnails (default: %default MB)')
+
     def run(self):
         if not gtk.gdk.get_display():
             self.option_parser.error('Cannot open the display.')
@@ -428,10 +746,14 @@ class GTKShell(Shell):
 
         self._update_flickr_wt()
 
-    @thread
+    @thread('flickr')
     def _update_flickr_wt(self):
         try:
-            index = self.make_index(self.flickr_proxy_cb, self.flickr_progress_cb)
+            index = self.make_index(self.flickr_proxy_cb,
+                                    self.flickr_progress_cb,
+                                    refresh=False)
+            index.refresh()
+            index.reconcile()
         except IOError:
             index = None
 
@@ -446,6 +768,7 @@ class GTKShell(Shell):
         msgs = {
             'photos': 'Loading updates from Flickr...',
             'hashes': 'Indexing photos on Flickr...',
+            'reconcile': 'Checking for photos deleted from Flickr...',
         }
 
         a, b = map(float, meta)
@@ -462,17 +785,32 @@ class GTKShell(Shell):
 
         self._scan_files_wt()
 
-    @thread
+    @thread('scan')
     def _scan_files_wt(self):
-        for fn in self.filenames:
-            if self.index.type(fn) == 'new':
-                self.file_new_cb(fn)
+        # The new images are handed to the mainloop in batches, named here.
+        batch, flushed = [], time.time()
+
+        for t, fn in self.index.types(self.scan(self.index)):
+            if EXECUTOR.closed:     # The window was closed.
+                return
+
+            if t == 'new':
+                uri = gio.File(fn).get_uri()
+                batch.append((uri, display_name(uri)))
+
+            if len(batch) >= self.SCAN_BATCH \
+               or (batch and time.time() - flushed >= self.SCAN_INTERVAL):
+                self.files_new_cb(batch)
+                batch, flushed = [], time.time()
+
+        if batch:
+            self.files_new_cb(batch)
 
         self.files_done_cb()
 
     @thunk
-    def file_new_cb(self, filename):
-        self.stores['new'].add(gio.File(filename).get_uri())
+    def files_new_cb(self, images):
+        self.stores['new'].extend(images)
         self.preview_window.set_status("%u new images scanned" % len(self.stores['new']))
 
     @thunk
@@ -489,36 +827,17 @@ class GTKShell(Shell):
         uploads = [gio.File(i.uri).get_path() for i in self.stores['upload']]
         self.upload(uploads)
 
-    @thread
+    @thread('upload')
     def upload(self, filenames):
-        ids = []
+        def _(progress, done):
+            self.upload_progress_cb(len(filenames) * progress / 100,
+                                    len(filenames))
 
-        def _upload(fns):
-            for n, fn in enumerate(fns):
-                def _(progress, done):
-                    if done:
-                        p = n + 1
-                    else:
-                        p = n + (progress / 100)
-                    self.upload_progress_cb(p, len(filenames))
+        scheduler = UploadScheduler(self.index, callback=_)
 
-                yield self.index.upload(fn, callback=_)
-
-        try:
-            for resp in _upload(filenames):
-                if resp is not None:
-                    photo_id = resp.find('photoid')
-
-                    if photo_id is not None:    # Ugly because the photoid element is a boolean False.
-                        ids.append(photo_id.text)
-                    else:
-                        LOG.debug('No photo_id in the enclosed response.')
-                        break
-                else:
-                    LOG.debug('No response from the upload proxy.')
-                    break
-        except (FlickrError, IOError):
-            LOG.exception('Upload failed.')
+        ids = [photo_id
+               for fn, photo_id in scheduler.upload(filenames)
+               if photo_id]
 
         url = 'http://www.flickr.com/tools/uploader_edit.gne?ids=' + ','.join(ids) if ids else None
 
@@ -528,6 +847,9 @@ class GTKShell(Shell):
     def upload_progress_cb(self, count, total):
         """Update the progress bar on the Flickr upload."""
 
+        if not total:   # Nothing to upload.
+            return
+
         self.preview_window.set_status(
             "%u of %u photos uploaded to Flickr" % (int(count), total),
             float(count) / float(total))
@@ -553,6 +875,14 @@ class GTKShell(Shell):
         if self.index:
             self.index.sync()
 
+        LOG.debug("Thumbnail cache: %(entries)u thumbnails in %(size)u bytes, "
+                  "%(hits)u hits, %(misses)u misses, %(evictions)u evictions",
+                  ImageStore.__thumbnailer__.cache.counters())
+
+        # Drop the pending work, and the callbacks of the work in progress.
+        ImageStore.__thumbnailer__.close()
+        EXECUTOR.shutdown()
+
         gtk.main_quit()
 
 
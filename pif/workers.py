@@ -0,0 +1,248 @@
+import Queue
+import sys
+import threading
+
+QUEUE_SIZE = 64
+
+
+class Worker(threading.Thread):
+    """A daemon thread, handing its result or exception to the waiter."""
+
+    def __init__(self, function, *args, **kwargs):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+
+        self.result = None
+        self.exc_info = None
+
+        self.start()
+
+    def run(self):
+        try:
+            self.result = self.function(*self.args, **self.kwargs)
+        except:
+            self.exc_info = sys.exc_info()
+
+    def wait(self):
+        """Wait for the function to return, raising its exception if any."""
+
+        self.join()
+
+        if self.exc_info:
+            type, value, traceback = self.exc_info
+            raise type, value, traceback
+
+        return self.result
+
+
+def pipe(iterable, size=QUEUE_SIZE):
+    """Consume an iterable in a worker thread, through a bounded queue.
+
+    The worker starts immediately and runs at most size items ahead of the
+    consumer, or without bound if size is 0. Its exceptions are raised in the
+    consumer."""
+
+    queue = Queue.Queue(size)
+    done = object()
+
+    def _feed():
+        try:
+            for item in iterable:
+                queue.put((item, None))
+        except:
+            queue.put((None, sys.exc_info()))
+        else:
+            queue.put((done, None))
+
+    Worker(_feed)
+
+    def _drain():
+        while True:
+            item, exc_info = queue.get()
+
+            if exc_info:
+                type, value, traceback = exc_info
+                raise type, value, traceback
+            elif item is done:
+                return
+
+            yield item
+
+    return _drain()
+
+
+class Cancelled(Exception):
+    """The job of a future was cancelled before it ran."""
+
+
+class Future(object):
+    """The eventual result of a job submitted to an Executor."""
+
+    PENDING, RUNNING, DONE, CANCELLED = range(4)
+
+    def __init__(self, executor, function, args, kwargs):
+        self.executor = executor
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+
+        self.condition = threading.Condition()
+        self.state = self.PENDING
+        self.value = None
+        self.exc_info = None
+        self.callbacks = []
+
+    def _finish(self, state):
+        with self.condition:
+            self.state = state
+            self.condition.notify_all()
+
+            callbacks, self.callbacks = self.callbacks, []
+
+        for callback in callbacks:
+            self.executor.dispatch(callback, self)
+
+    def _run(self):
+        with self.condition:
+            if self.state != self.PENDING:
+                return
+
+            self.state = self.RUNNING
+
+        try:
+            self.value = self.function(*self.args, **self.kwargs)
+        except:
+            self.exc_info = sys.exc_info()
+
+        self._finish(self.DONE)
+
+    def cancel(self):
+        """Cancel the job, unless it's already running or done."""
+
+        with self.condition:
+            if self.state != self.PENDING:
+                return self.state == self.CANCELLED
+
+            self.state = self.CANCELLED
+
+        self._finish(self.CANCELLED)
+
+        return True
+
+    def cancelled(self):
+        return self.state == self.CANCELLED
+
+    def done(self):
+        return self.state in (self.DONE, self.CANCELLED)
+
+    def add_done_callback(self, callback):
+        """Call callback(future) through the executor, once it's done."""
+
+        with self.condition:
+            if not self.done():
+                self.callbacks.append(callback)
+                return
+
+        self.executor.dispatch(callback, self)
+
+    def result(self, timeout=None):
+        """Wait for the result, raising the job's exception if any."""
+
+        with self.condition:
+            if not self.done():
+                self.condition.wait(timeout)
+
+            if self.state == self.CANCELLED:
+                raise Cancelled()
+            elif self.state != self.DONE:
+                raise RuntimeError('Timed out waiting for a result.')
+
+        if self.exc_info:
+            type, value, traceback = self.exc_info
+            raise type, value, traceback
+
+        return self.value
+
+
+class Executor(object):
+    """Run jobs on named queues, each served by a bounded number of threads.
+
+    Jobs queued beyond a queue's threads wait their turn, instead of piling
+    up threads. The callbacks of the futures are called through dispatch,
+    such as one handing them to a mainloop, until the executor is shut
+    down."""
+
+    THREADS = 1     # Per queue, unless given.
+
+    def __init__(self, threads=None, dispatch=None):
+        self.threads = dict(threads or {})
+        self._dispatch = dispatch
+
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.closed = False
+
+    def dispatch(self, function, *args):
+        if self.closed:
+            return
+        elif self._dispatch:
+            self._dispatch(function, *args)
+        else:
+            function(*args)
+
+    def _serve(self, queue):
+        while True:
+            future = queue.get()
+
+            if future is None:
+                return
+
+            future._run()
+
+    def _queue(self, name):
+        if name not in self.queues:
+            queue = self.queues[name] = Queue.Queue()
+
+            for i in xrange(self.threads.get(name, self.THREADS)):
+                Worker(self._serve, queue)
+
+        return self.queues[name]
+
+    def submit(self, name, function, *args, **kwargs):
+        """Queue a call of function, returning its future."""
+
+        future = Future(self, function, args, kwargs)
+
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('Submitted to a shut down executor.')
+
+            self._queue(name).put(future)
+
+        return future
+
+    def shutdown(self):
+        """Cancel the queued jobs and stop the threads once they're idle.
+
+        The running jobs aren't interrupted, but their callbacks are no
+        longer called."""
+
+        with self.lock:
+            self.closed = True
+            queues, self.queues = self.queues, {}
+
+        for name, queue in queues.iteritems():
+            while True:
+                try:
+                    future = queue.get_nowait()
+                except Queue.Empty:
+                    break
+
+                future.cancel()
+
+            for i in xrange(self.threads.get(name, self.THREADS)):
+                queue.put(None)
@@ -0,0 +1,31 @@
+import json
+import os
+import shutil
+import tempfile
+
+import benchmarks.__main__
+
+
+class TestBenchmarks:
+    """Benchmark suite tests."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.output = os.path.join(self.dir, 'results.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_run(self):
+        """Benchmarks run on a tiny library and record their results"""
+
+        benchmarks.__main__.main(['--files', '4', '--photos', '10',
+                                  '--repeat', '1', '-o', self.output])
+
+        with open(self.output) as f:
+            results = json.load(f)['results']
+
+        assert set(results) == set(c.__name__
+                                   for c in benchmarks.__main__.CASES)
+        assert results['hashes_refresh']['items'] == 12
+        assert results['files_rescan']['items'] == 4
@@ -0,0 +1,52 @@
+from pif.ui.cache import LRUCache
+
+
+class TestLRUCache:
+    """Size-aware LRU cache tests."""
+
+    def setUp(self):
+        self.cache = LRUCache(3 * (LRUCache.OVERHEAD + 10))
+
+    def test_get(self):
+        """LRUCache counts its hits and misses"""
+
+        self.cache['a'] = 'x' * 10
+
+        assert self.cache.get('a') == 'x' * 10
+        assert self.cache.get('b', 'default') == 'default'
+
+        counters = self.cache.counters()
+        assert counters['hits'] == 1
+        assert counters['misses'] == 1
+
+    def test_evict(self):
+        """LRUCache evicts the least recently used values over its ceiling"""
+
+        for k in 'abc':
+            self.cache[k] = k * 10
+
+        self.cache.get('a')
+        self.cache['d'] = 'd' * 10
+
+        assert 'a' in self.cache
+        assert 'b' not in self.cache
+        assert self.cache.counters()['evictions'] == 1
+        assert self.cache.size == 3 * (LRUCache.OVERHEAD + 10)
+
+    def test_replace(self):
+        """LRUCache resizes a replaced value"""
+
+        self.cache['a'] = 'a' * 10
+        self.cache['a'] = 'a' * 20
+
+        assert len(self.cache) == 1
+        assert self.cache.size == LRUCache.OVERHEAD + 20
+
+    def test_oversized(self):
+        """LRUCache doesn't keep a value bigger than its ceiling"""
+
+        self.cache['a'] = 'a' * 10
+        self.cache['big'] = 'x' * self.cache.ceiling
+
+        assert 'big' not in self.cache
+        assert 'a' in self.cache
@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+import time
+
+from benchmarks.fixtures import make_tree
+from pif.ui.console import ConsoleShell
+
+
+class _Shell(ConsoleShell):
+    """A console shell with a slow refresh, counting the files hashed."""
+
+    def __init__(self, config_dir, args):
+        ConsoleShell.__init__(self, args)
+
+        self.config_dir = config_dir
+        self.hashed = []
+        self.hashed_in_refresh = None
+
+    def make_index(self, *args, **kwargs):
+        kwargs['config_dir'] = self.config_dir
+        index = ConsoleShell.make_index(self, *args, **kwargs)
+
+        hash_many = index.files.hash_many
+
+        def _(*args, **kwargs):
+            for result in hash_many(*args, **kwargs):
+                self.hashed.append(result)
+                yield result
+
+        index.files.hash_many = _
+        self.index = index
+
+        return index
+
+    def _refresh(self, index):
+        deadline = time.time() + 30
+
+        while len(self.hashed) < self.count and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.hashed_in_refresh = len(self.hashed)
+
+
+class TestConsoleShell:
+    """Console shell tests."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.tree = os.path.join(self.dir, 'tree')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_hash_during_refresh(self):
+        """Console hashes every file while Flickr is being refreshed"""
+
+        filenames = make_tree(self.tree, 100, per_dir=50)
+
+        shell = _Shell(os.path.join(self.dir, 'config'),
+                       ['--dry-run', self.tree])
+        shell.count = len(filenames)
+        shell.run()
+
+        assert shell.hashed_in_refresh == len(filenames), \
+            shell.hashed_in_refresh
+
+    def test_strict(self):
+        """Console verifies whole images when strict"""
+
+        filenames = make_tree(self.tree, 4)
+
+        shell = _Shell(os.path.join(self.dir, 'config'),
+                       ['--dry-run', '--strict', self.tree])
+        shell.count = len(filenames)
+        shell.run()
+
+        assert shell.index.files.STRICT
+        assert len(shell.hashed) == len(filenames), shell.hashed
@@ -1,7 +1,9 @@
 from __future__ import with_statement
 
 import json
+import multiprocessing
 import os.path
+import re
 import shutil
 import tempfile
 import time
@@ -10,11 +12,14 @@ import unittest
 import PIL.Image
 import PIL.ImageDraw
 
-from nose.tools import raises
+import minimock
+
+from nose.tools import assert_raises, raises
 
 import pif
 
-from pif.local import FileIndex
+from pif.dictdb import DictDB
+from pif.local import DirectoryIndex, FileIndex
 
 from tests import DATA
 
@@ -29,6 +34,7 @@ class FileIndexNullTests(unittest.TestCase):
     def test_no_hashes(self):
         """Empty FileIndex is empty"""
         assert not self.index.keys()
+        assert not self.index
 
 
 class FileIndexSmallDirTests(unittest.TestCase):
@@ -61,6 +67,7 @@ class FileIndexSmallDirTests(unittest.TestCase):
         """Images able to be added to FileIndex"""
 
         assert len(self.index) == len(self.shorthashes), "%s != %s" % (self.index, self.shorthashes)
+        assert self.index
 
     def test_rescan(self):
         """FileIndex detects changed images"""
@@ -90,6 +97,37 @@ class FileIndexSmallDirTests(unittest.TestCase):
 
         self.index[b_fn]
 
+    def test_add_file_unknown_format(self):
+        """Images in formats Flickr doesn't take are ignored by FileIndex"""
+
+        fn = os.path.join(self.tempdir, 'bitmap.jpg')
+        PIL.Image.new('RGB', (8, 8)).save(fn, 'BMP')
+
+        assert_raises(KeyError, lambda: self.index[fn])
+        assert dict(self.index.hash_many([fn], workers=2)) == {fn: None}
+
+    def test_strict(self):
+        """Strict FileIndex verifies whole images"""
+
+        fn = os.path.join(self.tempdir, 'broken.png')
+
+        with open(os.path.join(DATA, 'images', 'superjoe.png'), 'rb') as f:
+            data = f.read()
+
+        # Corrupt the image data, keeping the header.
+        middle = len(data) // 2
+        data = data[:middle] + chr(ord(data[middle]) ^ 0xff) + data[middle + 1:]
+
+        with open(fn, 'wb') as f:
+            f.write(data)
+
+        assert self.index[fn]
+
+        index = FileIndex(os.path.join(self.tempdir, 'strict_index'))
+        index.STRICT = True
+
+        assert_raises(KeyError, index.__getitem__, fn)
+
     def test_adds(self):
         """FileIndex calculates shorthashes correctly"""
 
@@ -101,4 +139,195 @@ class FileIndexSmallDirTests(unittest.TestCase):
                         repr(self.shorthashes[fn]),
                     )
 
+    def test_hash_many(self):
+        """FileIndex hashes many images in parallel"""
+
+        b_fn = os.path.join(self.tempdir, 'badfile.png')
+
+        with open(b_fn, 'w') as bf:
+            bf.write('abc123')
+
+        index = FileIndex(os.path.join(self.tempdir, 'other_index'))
+        results = dict(index.hash_many(self.shorthashes.keys() + [b_fn],
+                                       workers=2))
+
+        assert results.pop(b_fn) is None
+        assert results == self.shorthashes, results
+
+        for fn in self.shorthashes:
+            assert index[fn] == self.shorthashes[fn]
+
+    def test_hash_many_cached(self):
+        """FileIndex hashing many images uses the cache"""
+
+        results = dict(self.index.hash_many(self.shorthashes, workers=1))
+
+        assert results == self.shorthashes, results
+
+    def test_hash_many_cached_no_pool(self):
+        """FileIndex hashing cached images starts no worker processes"""
+
+        minimock.mock('multiprocessing.Pool', raises=AssertionError)
+
+        try:
+            results = dict(self.index.hash_many(self.shorthashes, workers=2))
+        finally:
+            minimock.restore()
+
+        assert results == self.shorthashes, results
+
+    def test_filenames(self):
+        """FileIndex finds the files with a shorthash"""
+
+        fn = self.index.keys().pop()
+        copy_fn = os.path.join(self.tempdir, 'copy-' + os.path.basename(fn))
+        shutil.copy(fn, copy_fn)
+
+        assert self.index[copy_fn] == self.index[fn]
+        assert self.index.filenames(self.index[fn]) == [fn, copy_fn]
+
+        del self.index[fn]
+
+        assert self.index.filenames(self.index[copy_fn]) == [copy_fn]
+
+    def test_filenames_rebuild(self):
+        """The shorthash filenames are rebuilt for old file indexes"""
+
+        self.index.sync()
+        os.remove(self.index.filename + '-inverted')
+
+        index = FileIndex(self.index.filename)
+
+        for fn, sh in self.shorthashes.iteritems():
+            assert index.filenames(sh) == [fn]
+
+    def test_storage(self):
+        """FileIndex stores files by directory"""
+
+        self.index.sync()
+
+        entries = DictDB(self.index.filename)
+
+        assert entries.keys() == [self.tempdir]
+        assert len(entries[self.tempdir]) == len(self.shorthashes)
+
+        index = FileIndex(self.index.filename)
+
+        assert dict((fn, sh) for fn, (mtime, sh) in index.iteritems()) \
+                == self.shorthashes
+
+    def test_storage_non_ascii(self):
+        """FileIndex stores files whose paths aren't ASCII"""
+
+        src = self.shorthashes.keys()[0]
+        fn = os.path.join(self.tempdir, 'caf\xc3\xa9', '\xc3\xa9t\xc3\xa9.png')
+
+        os.mkdir(os.path.dirname(fn))
+        shutil.copy(src, fn)
+
+        sh = self.index[fn]
+        self.index.sync()
+
+        index = FileIndex(self.index.filename)
+
+        assert fn in index
+        assert index._cached(fn) == sh
+        assert fn in list(index), list(index)
+        assert index.filenames(sh) == [src, fn], index.filenames(sh)
+
+    def test_migrate(self):
+        """FileIndex migrates indexes of whole filenames"""
+
+        fn = os.path.join(self.tempdir, 'old_index')
+
+        old = DictDB(fn)
+
+        for f, sh in self.shorthashes.iteritems():
+            old[f] = (os.stat(f).st_mtime, sh)
+
+        old.sync()
+
+        index = FileIndex(fn)
+
+        assert DictDB(fn).keys() == [self.tempdir]
+
+        for f, sh in self.shorthashes.iteritems():
+            assert index._cached(f) == sh
+
+    def test_migrate_lost_version(self):
+        """FileIndex doesn't migrate again when its version is lost"""
+
+        self.index.sync()
+        os.remove(self.index.filename + '-meta')
+
+        index = FileIndex(self.index.filename)
+
+        for f, sh in self.shorthashes.iteritems():
+            assert index._cached(f) == sh
+
     # TODO: Save and restore!
+
+
+class DirectoryIndexTests(unittest.TestCase):
+    """DirectoryIndex tests with a small test fixture."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.index = DirectoryIndex(os.path.join(self.tempdir, 'index'))
+
+        self.imagedir = os.path.join(self.tempdir, 'images')
+        shutil.copytree(os.path.join(DATA, 'images'), self.imagedir)
+
+        self.match = re.compile(r'.*\.(jpe?g|gif|png)$', re.IGNORECASE).match
+
+    def tearDown(self):
+        minimock.restore()
+
+        shutil.rmtree(self.tempdir)
+
+    def test_walk(self):
+        """DirectoryIndex finds matching images"""
+
+        fns = [fn for fn, st in self.index.walk(self.imagedir, self.match)]
+
+        assert fns == [os.path.join(self.imagedir, fn) for fn in (
+            'abc123.jpeg', 'superjoe.png', 'test.jpg', 'xyzzy.GIF')], fns
+
+    def test_walk_cached(self):
+        """DirectoryIndex doesn't relist unchanged directories"""
+
+        first = list(self.index.walk(self.imagedir, self.match))
+
+        minimock.mock('os.listdir', raises=AssertionError)
+
+        assert list(self.index.walk(self.imagedir, self.match)) == first
+
+    def test_walk_modified_in_place(self):
+        """DirectoryIndex stats the files of unchanged directories"""
+
+        fn = os.path.join(self.imagedir, 'test.jpg')
+        list(self.index.walk(self.imagedir, self.match))
+
+        # Rewriting a file leaves its directory's mtime alone.
+        mtime = os.stat(fn).st_mtime + 10
+        os.utime(fn, (mtime, mtime))
+
+        minimock.mock('os.listdir', raises=AssertionError)
+
+        stats = dict(self.index.walk(self.imagedir, self.match))
+
+        assert stats[fn].st_mtime == mtime, stats[fn]
+
+    def test_walk_changed(self):
+        """DirectoryIndex relists changed directories"""
+
+        list(self.index.walk(self.imagedir, self.match))
+
+        time.sleep(1)   # The timestamp must tick.
+        os.mkdir(os.path.join(self.imagedir, 'sub'))
+        shutil.copy(os.path.join(self.imagedir, 'test.jpg'),
+                    os.path.join(self.imagedir, 'sub', 'new.jpg'))
+
+        fns = [fn for fn, st in self.index.walk(self.imagedir, self.match)]
+
+        assert os.path.join(self.imagedir, 'sub', 'new.jpg') in fns, fns
@@ -1,6 +1,7 @@
 import glob
 import os
 import os.path
+import shutil
 import tempfile
 import urllib2
 
@@ -14,7 +15,8 @@ import minimock
 from minimock import Mock
 from nose.tools import assert_raises, raises
 
-from pif.flickr import FlickrError, PhotoIndex, get_proxy
+from pif.dictdb import DictDB
+from pif.flickr import FlickrError, Photo, PhotoIndex, TokenCache, get_proxy
 
 from tests import DATA
 
@@ -115,6 +117,42 @@ class TestProxy:
         assert self.hit_cb
 
 
+class TestTokenCache:
+    """Flickr token cache tests."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+        self.cache = TokenCache('key', os.path.join(self.dir, 'pif'))
+        self.cache.legacy.path = os.path.join(self.dir, 'flickr')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_empty(self):
+        """Empty token cache"""
+
+        assert self.cache.token is None
+
+    def test_private(self):
+        """Cached tokens are private"""
+
+        self.cache.token = 'token'
+
+        fn = self.cache.get_cached_token_filename()
+
+        assert os.stat(fn).st_mode & 0777 == 0600
+        assert TokenCache('key', os.path.join(self.dir, 'pif')).token == 'token'
+
+    def test_legacy(self):
+        """Tokens cached by flickrapi are adopted"""
+
+        self.cache.legacy.token = 'legacy'
+
+        assert self.cache.token == 'legacy'
+        assert os.path.exists(self.cache.get_cached_token_filename())
+
+
 class TestPhotoIndex:
     """Flickr Photo Index API tests."""
 
@@ -126,6 +164,9 @@ class TestPhotoIndex:
     def tearDown(self):
         minimock.restore()
 
+    def make_photo(self, photo_id, **attrib):
+        return Photo.from_attrib(dict(attrib, id=photo_id))
+
     def test_init_no_proxy(self):
         """Initialize PhotoIndex with no proxy"""
 
@@ -139,6 +180,54 @@ class TestPhotoIndex:
         assert not self.index.keys()
         assert self.index.last_update == 0
 
+    def test_last_update(self):
+        """PhotoIndex keeps the latest update"""
+
+        self.index['123'] = self.make_photo('123', lastupdate='20')
+        self.index['321'] = self.make_photo('321', lastupdate='10')
+
+        assert self.index.last_update == 20
+
+        self.index.sync()
+
+        assert PhotoIndex(None, self.index_fn).last_update == 20
+
+    def test_last_update_rebuild(self):
+        """The latest update is rebuilt for old photo indexes"""
+
+        self.index['123'] = self.make_photo('123', lastupdate='20')
+        self.index.sync()
+
+        os.remove(self.index_fn + '-meta')
+
+        assert PhotoIndex(None, self.index_fn).last_update == 20
+
+    def test_photo(self):
+        """Photo records parse the Flickr attributes"""
+
+        p = Photo.from_attrib({
+            'id': '123',
+            'dateupload': '10',
+            'o_width': '1544',
+            'secret': 'unused',
+        })
+
+        assert p == ('123', 10, None, None, 1544, None, None), p
+
+    def test_migrate(self):
+        """Photo attribute dicts are migrated to records"""
+
+        old = DictDB(self.index_fn)
+        old['123'] = {'id': '123', 'lastupdate': '20', 'secret': 'unused'}
+        old.sync()
+
+        index = PhotoIndex(None, self.index_fn)
+
+        assert index['123'] == self.make_photo('123', lastupdate='20')
+        assert index.last_update == 20
+        assert PhotoIndex(None, self.index_fn).store.get('123') == \
+                ['123', None, 20, None, None, None, None]
+
     @raises(AssertionError)
     def test_refresh_fail_no_proxy(self):
         """PhotoIndex refresh fails without a proxy"""
@@ -193,15 +282,84 @@ class TestPhotoIndex:
 
         assert not self.index.refresh()
 
+    def test_reconcile(self):
+        """PhotoIndex forgets photos deleted from Flickr"""
+
+        self.index['123'] = self.make_photo('123')
+        self.index['321'] = self.make_photo('321')
+
+        self.proxy.people_getPhotos.mock_returns = XML("""
+                        <rsp>
+                            <photos page="1" pages="1" total="1">
+                                <photo id="123" />
+                            </photos>
+                        </rsp>""")
+
+        assert self.index.reconcile() == ['321']
+        assert self.index.keys() == ['123']
+
+    def test_reconcile_large(self):
+        """PhotoIndex lists photostreams past the search limit"""
+
+        pids = map(str, xrange(5000))
+
+        for pid in pids + ['deleted']:
+            self.index[pid] = self.make_photo(pid)
+
+        def _page(page, per_page, **kwargs):
+            return XML("""
+                <rsp>
+                    <photos page="%u" pages="%u" total="%u">%s</photos>
+                </rsp>""" % (page, len(pids) // per_page, len(pids), ''.join(
+                    '<photo id="%s" />' % pid
+                    for pid in pids[(page - 1) * per_page:page * per_page])))
+
+        self.proxy.people_getPhotos.mock_returns_func = _page
+        self.proxy.people_getPhotos.mock_tracker = None
+
+        assert self.index.reconcile() == ['deleted']
+        assert len(self.index) == len(pids)
+
+    @raises(FlickrError)
+    def test_reconcile_incomplete(self):
+        """PhotoIndex doesn't trust an incomplete photostream"""
+
+        self.index['123'] = self.make_photo('123')
+        self.index['321'] = self.make_photo('321')
+
+        self.proxy.people_getPhotos.mock_returns = XML("""
+                        <rsp>
+                            <photos page="1" pages="1" total="2">
+                                <photo id="123" />
+                            </photos>
+                        </rsp>""")
+
+        try:
+            self.index.reconcile()
+        finally:
+            assert len(self.index) == 2
+
     def _run_scripted_test(self, test):
         """Helper function to run a scripted doctest"""
 
-        script = (XML(p)
+        script = [XML(p)
                   for p in DocTestParser().parse(test._dt_test.docstring)
-                  if isinstance(p, str) and p.strip())
+                  if isinstance(p, str) and p.strip()]
+
+        # The pages after the first are requested concurrently, so each
+        # refresh answers them by number, after its first page.
+        first = [0, 0]  # Of this refresh, and of the next.
+
+        def _page(page, **kwargs):
+            if page == 1:
+                first[0] = first[1]
+                photos = script[first[0]].find('photos')
+                first[1] += int(photos.get('pages', 1))
+
+            return script[first[0] + page - 1]
 
         self.proxy.photos_recentlyUpdated.mock_returns = None
-        self.proxy.photos_recentlyUpdated.mock_returns_iter = script
+        self.proxy.photos_recentlyUpdated.mock_returns_func = _page
 
         _ = self.index.refresh()
 
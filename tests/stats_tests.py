@@ -0,0 +1,89 @@
+import json
+import os
+import tempfile
+
+import pif.stats
+
+from pif.stats import Stats
+
+
+class TestStats:
+    """Stage statistics tests."""
+
+    def setUp(self):
+        self.stats = Stats()
+        self.stats.enable()
+
+    def test_disabled(self):
+        """Disabled stats record nothing"""
+
+        stats = Stats()
+
+        with stats.timer('stage'):
+            stats.count('counter')
+
+        assert stats.snapshot() == {'stages': {}, 'counters': {}}
+
+    def test_record(self):
+        """Stats time stages and add up counters"""
+
+        for i in xrange(3):
+            with self.stats.timer('stage'):
+                self.stats.count('counter', 2)
+
+        report = self.stats.report()
+
+        assert report['stages']['stage']['calls'] == 3
+        assert report['counters']['counter']['total'] == 6
+
+    def test_merge(self):
+        """Stats merge the snapshots of other processes"""
+
+        other = Stats()
+        other.enable()
+        other.add('stage', 1.5)
+        other.count('counter')
+
+        self.stats.add('stage', 0.5)
+        self.stats.merge(other.snapshot())
+
+        assert self.stats.snapshot() == {
+            'stages': {'stage': [2, 2.0]},
+            'counters': {'counter': 1},
+        }
+
+    def test_dump(self):
+        """Stats dump their report as JSON"""
+
+        self.stats.add('stage', 2.0, calls=4)
+
+        fd, fn = tempfile.mkstemp()
+        os.close(fd)
+
+        try:
+            self.stats.dump(fn)
+
+            with open(fn) as f:
+                report = json.load(f)
+        finally:
+            os.remove(fn)
+
+        assert report['stages']['stage']['per_second'] == 2.0
+        assert 'stage' in self.stats.format()
+
+    def test_reinit(self):
+        """Reinitialized stats don't wait on the lock of the old ones"""
+
+        old = pif.stats.STATS
+        old.enable()
+
+        try:
+            with old.lock:
+                pif.stats.reinit()
+                pif.stats.count('counter')
+
+            assert pif.stats.STATS is not old
+            assert pif.stats.STATS.snapshot()['counters'] == {'counter': 1}
+        finally:
+            pif.stats.STATS = old
+            old.enabled = False
@@ -1,5 +1,6 @@
 import json
 import os
+import shutil
 import tempfile
 
 import minimock
@@ -7,7 +8,9 @@ import minimock
 from minimock import assert_same_trace
 from nose.tools import raises
 
-from pif.dictdb import DictDB
+import pif
+
+from pif.dictdb import DictDB, ShorthashDB
 
 
 class TestInits:
@@ -37,3 +40,103 @@ class TestInits:
 
         assert DictDB(self.file.name) == {}
         assert_same_trace(self.trace, "Called json.load(<open file '%s', mode 'r' at 0x...>)" % self.file.name)
+
+
+class TestSQLiteStore:
+    """Tests for the incremental SQLite storage of the DictDB."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'database')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_lazy_create(self):
+        """DictDB doesn't create its file until there is something to sync"""
+
+        db = DictDB(self.filename)
+        db.sync()
+
+        assert not os.path.exists(self.filename)
+
+    def test_roundtrip(self):
+        """DictDB persists changes"""
+
+        db = DictDB(self.filename)
+        db['a'] = [1, 'x']
+        db['b'] = 2
+        db.sync()
+
+        db = DictDB(self.filename)
+        assert db == {'a': [1, 'x'], 'b': 2}, db
+
+        del db['b']
+        db['c'] = None
+        db.sync()
+
+        assert DictDB(self.filename) == {'a': [1, 'x'], 'c': None}
+
+    def test_roundtrip_non_ascii(self):
+        """DictDB persists byte string keys which aren't ASCII"""
+
+        db = DictDB(self.filename)
+        db['caf\xc3\xa9'] = 1
+        db['\xe9t\xe9'] = 2
+        db.sync()
+
+        db = DictDB(self.filename)
+        assert db['caf\xc3\xa9'] == 1
+        assert sorted(db) == ['caf\xc3\xa9', '\xe9t\xe9'], db.keys()
+
+        del db['\xe9t\xe9']
+        db.sync()
+
+        assert DictDB(self.filename) == {'caf\xc3\xa9': 1}
+
+    def test_sync_changes(self):
+        """DictDB only writes changed keys"""
+
+        db = DictDB(self.filename)
+        db['a'] = 1
+        db['b'] = 2
+        db.sync()
+
+        trace = minimock.TraceTracker()
+        minimock.mock('json.dumps', tracker=trace, returns='3')
+
+        db['a']
+        db['b'] = 3
+        db.sync()
+
+        assert_same_trace(trace, "Called json.dumps(3)")
+
+    def test_migrate(self):
+        """DictDB migrates a JSON file"""
+
+        with open(self.filename, 'w') as f:
+            json.dump({'a': 1}, f)
+
+        assert DictDB(self.filename) == {'a': 1}
+
+        with open(self.filename) as f:
+            assert f.read(6) == 'SQLite'
+
+    def test_shorthash_keys(self):
+        """ShorthashDB keeps its keys as shorthashes"""
+
+        sh = pif.make_shorthash('tail', 'jpg', 1, 2, 3)
+
+        db = ShorthashDB(self.filename)
+        db[sh] = 1
+        db['other'] = 2
+        db.sync()
+
+        assert DictDB(self.filename) == {str(sh): 1, 'other': 2}
+
+        db = ShorthashDB(self.filename)
+        keys = sorted(db, key=lambda k: k == 'other')
+
+        assert keys == [sh, 'other'], keys
+        assert isinstance(keys[0], pif.Shorthash)
+        assert db[sh] == 1
@@ -1,7 +1,10 @@
+import BaseHTTPServer
 import os
 import random
+import SocketServer
 import sys
 import tempfile
+import threading
 import eventlet.green.urllib2 as urllib2
 
 import minimock
@@ -11,8 +14,8 @@ from nose.tools import raises
 
 import pif.hash
 
-from pif.flickr import FlickrError
-from pif.hash import HashIndex
+from pif.flickr import FlickrError, Photo
+from pif.hash import HashIndex, HTTPPool
 
 from tests.mock import MockDict
 
@@ -28,7 +31,8 @@ class TestHashIndex:
         self.index = HashIndex(self.photos, filename=self.index_fn)
 
         self.urls = {}
-        minimock.mock('urllib2.urlopen', returns_func=self._mock_urlopen)
+        self.index.http = Mock('HTTPPool', tracker=None)
+        self.index.http.urlopen.mock_returns_func = self._mock_urlopen
 
         self.tails = {}
         minimock.mock('pif.hash.make_shorthash', returns_func=self._mock_shorthash)
@@ -52,14 +56,13 @@ class TestHashIndex:
         self.photos.refresh.mock_returns.append(photo_id)
 
         # The fake photo ID points at the PhotoIndex record.
-        self.photos[photo_id] = {
+        self.photos[photo_id] = Photo.from_attrib({
             'id': photo_id,
             'originalformat': format,
             'o_height': str(h),
             'o_width': str(w),
-            'size': str(s),
             'url_o': url,
-        }
+        })
 
         # The record's URL points at the request.
         tail = 'tail data' + photo_id
@@ -155,24 +158,66 @@ class TestHashIndex:
 
         self.index.refresh()
 
-    @raises(IOError)
     def test_complete(self):
         """Wrong status from Flickr for photo download"""
 
         self.make_mock_photo('123')
         self.urls.values()[0].code = 404
 
-        self.index.refresh()
+        assert self.index.refresh() == []
+        assert '123' in self.index.failed
 
-    @raises(IOError)
     def test_get_fail(self):
         """Fail shorthash retrieval"""
 
-        self.make_mock_photo('123')
+        sh = self.make_mock_photo('123')
+        self.make_mock_photo('321')
+
+        def _(request):
+            if '123' in request.get_full_url():
+                raise IOError()
+            else:
+                return self._mock_urlopen(request)
 
-        minimock.mock('urllib2.urlopen', raises=IOError)
+        self.index.http.urlopen.mock_returns_func = _
 
-        self.index.refresh()
+        assert self.index.refresh() == ['short hash321']
+        assert self.index.failed.keys() == ['123']
+        assert not self.index.pending
+
+        # Failed photos are retried on the next refresh.
+        self.photos.refresh.mock_returns = []
+        self.index.http.urlopen.mock_returns_func = self._mock_urlopen
+
+        assert self.index.refresh() == [sh]
+        assert not self.index.failed
+
+    def test_resume(self):
+        """Resume an interrupted refresh"""
+
+        sh = self.make_mock_photo('123')
+        self.photos.refresh.mock_returns = []
+
+        self.index.pending['123'] = True
+
+        assert self.index.refresh() == [sh]
+        assert not self.index.pending
+
+    def test_checkpoint(self):
+        """Refresh checkpoints its progress"""
+
+        self.index.CHECKPOINT = 1
+
+        shs = map(self.make_mock_photo, map(str, range(3)))
+        synced = []
+
+        def _sync():
+            synced.append(len(self.index.pending))
+
+        self.index.pending.sync = _sync
+
+        assert set(self.index.refresh()) == set(shs)
+        assert synced == [3, 2, 1, 0, 0], synced
 
     @raises(SystemError)
     def test_get_fail_bad(self):
@@ -180,7 +225,7 @@ class TestHashIndex:
 
         self.make_mock_photo('123')
 
-        minimock.mock('urllib2.urlopen', raises=SystemError)
+        self.index.http.urlopen.mock_raises = SystemError
 
         self.index.refresh()
 
@@ -190,7 +235,6 @@ class TestHashIndex:
         shs = map(self.make_mock_photo, map(str, range(10)))
 
         fails = []
-        old_open = urllib2.urlopen
 
         def _(request):
             fails.append(True)
@@ -198,9 +242,9 @@ class TestHashIndex:
             if len(fails) < 3:
                 raise IOError()
             else:
-                return old_open(request)
+                return self._mock_urlopen(request)
 
-        minimock.mock('urllib2.urlopen', returns_func=_)
+        self.index.http.urlopen.mock_returns_func = _
 
         assert set(self.index.refresh()) == set(shs)
 
@@ -286,3 +330,186 @@ class TestHashIndex:
         self.index[sh_b] += [None]
 
         assert self.index.refresh() == []
+
+    def test_shorthash_for(self):
+        """Lookup the shorthash of a photo ID"""
+
+        sh_old = self.make_mock_photo('123')
+        self.index.refresh()
+
+        assert self.index.shorthash_for('123') == sh_old
+        assert self.index.shorthash_for('321') is None
+
+        for k in self.tails:
+            self.tails[k] = 'somethingnew'
+
+        self.index.refresh()
+
+        assert self.index.shorthash_for('123') == 'somethingnew'
+
+    def test_reconcile(self):
+        """Photos deleted from Flickr are forgotten"""
+
+        sh_a = self.make_mock_photo('123')
+        sh_b = self.make_mock_photo('321')
+        self.index.refresh()
+
+        self.index[sh_b] += [None]
+        self.photos.reconcile.mock_returns = ['123', '321']
+
+        assert self.index.reconcile() == ['123', '321']
+        assert sh_a not in self.index
+        assert self.index[sh_b] == [None]
+        assert self.index.shorthash_for('123') is None
+
+    def test_inverted_rebuild(self):
+        """The inverted index is rebuilt for old hash indexes"""
+
+        self.index['a'] = ['123', None]
+        self.index['b'] = ['321']
+        self.index.sync()
+
+        os.remove(self.index_fn + '-inverted')
+
+        i = HashIndex(self.photos, self.index_fn)
+
+        assert i.shorthash_for('123') == 'a'
+        assert i.shorthash_for('321') == 'b'
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+
+        if self.path.endswith('/whole.jpg'):     # Ignores the range.
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(self.server.whole)))
+            self.end_headers()
+
+            try:
+                self.wfile.write(self.server.whole)
+            except IOError:     # The client hung up.
+                pass
+
+            return
+
+        if self.path.endswith('/moved.jpg'):
+            self.send_response(302)
+            self.send_header('Location', '/photo.jpg')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = 'x' * 1000
+        start = len(body) - int(self.headers['range'].split('-')[-1])
+
+        self.send_response(206)
+        self.send_header('Content-Range',
+                         'bytes %u-%u/%u' % (start, len(body) - 1, len(body)))
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+        self.wfile.write(body[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestHTTPPool:
+    """Keep-alive connection pool tests."""
+
+    def setUp(self):
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.server.connections = 0
+        self.server.paths = []
+        self.server.whole = 'x' * 2 ** 24
+
+        t = threading.Thread(target=self.server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+
+        self.url = 'http://127.0.0.1:%u/photo.jpg' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _get(self, pool, url=None):
+        return pool.urlopen(urllib2.Request(url or self.url,
+                                            headers={'Range': 'bytes=-512'}))
+
+    def test_range(self):
+        """HTTPPool gets a range"""
+
+        f = self._get(HTTPPool(1, proxies={}))
+
+        assert f.code == urllib2.httplib.PARTIAL_CONTENT
+        assert f.headers['content-range'] == 'bytes 488-999/1000'
+        assert f.read() == 'x' * 512
+
+    def test_keep_alive(self):
+        """HTTPPool reuses its connections"""
+
+        pool = HTTPPool(1, proxies={})
+
+        for i in xrange(3):
+            self._get(pool)
+
+        assert self.server.connections == 1, self.server.connections
+
+    def test_dropped(self):
+        """HTTPPool reconnects when an idle connection was dropped"""
+
+        pool = HTTPPool(1, proxies={})
+        self._get(pool)
+
+        for conn in pool.idle.values()[0]:
+            conn.sock.close()
+
+        assert self._get(pool).read() == 'x' * 512
+        assert self.server.connections == 2, self.server.connections
+
+    def test_redirect(self):
+        """HTTPPool follows a redirect, keeping the range"""
+
+        pool = HTTPPool(1, proxies={})
+        f = self._get(pool, self.url.replace('photo', 'moved'))
+
+        assert f.code == urllib2.httplib.PARTIAL_CONTENT
+        assert f.url == self.url, f.url
+        assert f.read() == 'x' * 512
+        assert self.server.connections == 1, self.server.connections
+
+    def test_proxy(self):
+        """HTTPPool goes through a proxy"""
+
+        proxy = 'http://127.0.0.1:%u' % self.server.server_port
+        pool = HTTPPool(1, proxies={'http': proxy})
+        f = self._get(pool, 'http://photos.invalid/photo.jpg')
+
+        assert f.code == urllib2.httplib.PARTIAL_CONTENT
+        assert f.read() == 'x' * 512
+        assert self.server.paths == ['http://photos.invalid/photo.jpg'], \
+            self.server.paths
+
+    def test_not_partial(self):
+        """HTTPPool doesn't read a response that isn't a range"""
+
+        pool = HTTPPool(1, proxies={})
+        f = self._get(pool, self.url.replace('photo', 'whole'))
+
+        assert f.code == 200
+        assert f.read() == ''
+        assert not pool.idle.values()[0]
+
+        assert self._get(pool).read() == 'x' * 512
+        assert self.server.connections == 2, self.server.connections
@@ -1,5 +1,7 @@
 import os.path
 
+from xml.etree.ElementTree import XML
+
 import minimock
 
 from minimock import Mock
@@ -9,12 +11,16 @@ import pif.flickr
 import pif.hash
 import pif.local
 
-from pif.index import Index
+from pif.index import Index, UploadScheduler
 
 
 class MockIndex(dict):
     def __init__(self, name):
         self.refresh = Mock(name + '.refresh()')
+        self.synced = []
+
+    def sync(self):
+        self.synced.append(dict(self))
 
 class TestIndexFiles:
     """Tests for indexing of files."""
@@ -112,3 +118,94 @@ class TestIndexChanges:
         """Try to upload without a valid file"""
 
         self.index.upload('x.jpg')
+
+
+class TestUploadScheduler:
+    """Tests for concurrent uploads."""
+
+    def setUp(self):
+        minimock.mock('os.path.isdir', returns=True)
+
+        self.proxy = Mock('FlickrProxy', tracker=None)
+        minimock.mock('pif.flickr.get_proxy', returns=self.proxy)
+
+        self.files = {'x.jpg': 'hash_x', 'y.jpg': 'hash_y'}
+        minimock.mock('pif.local.FileIndex', returns=self.files)
+
+        minimock.mock('pif.flickr.PhotoIndex', returns=Mock('PhotoIndex'))
+
+        self.hashes = MockIndex('HashIndex')
+        minimock.mock('pif.hash.HashIndex', returns=self.hashes)
+
+        self.index = Index()
+
+        self.scheduler = UploadScheduler(self.index)
+        self.scheduler.BACKOFF = 0
+
+    def tearDown(self):
+        minimock.restore()
+
+    def _upload(self, filename, callback=None):
+        return XML("<rsp><photoid>%s</photoid></rsp>" % filename[0])
+
+    def test_upload(self):
+        """Uploads are recorded in the index"""
+
+        self.proxy.upload.mock_returns_func = self._upload
+
+        results = dict(self.scheduler.upload(['x.jpg', 'y.jpg']))
+
+        assert results == {'x.jpg': 'x', 'y.jpg': 'y'}, results
+        assert self.index.type('x.jpg') == 'old'
+        assert self.hashes['hash_y'] == ['y']
+
+        # Each upload is saved as it completes.
+        assert len(self.hashes.synced) == 2, self.hashes.synced
+        assert self.hashes.synced[-1] == {'hash_x': ['x'], 'hash_y': ['y']}
+
+    def test_retry(self):
+        """Failed uploads are retried"""
+
+        fails = []
+
+        def _(filename, callback=None):
+            if not fails:
+                fails.append(filename)
+                raise IOError()
+
+            return self._upload(filename, callback)
+
+        self.proxy.upload.mock_returns_func = _
+
+        assert dict(self.scheduler.upload(['x.jpg'])) == {'x.jpg': 'x'}
+        assert fails == ['x.jpg']
+
+    def test_fail(self):
+        """Uploads give up after their retries"""
+
+        self.proxy.upload.mock_raises = IOError
+
+        assert dict(self.scheduler.upload(['x.jpg'])) == {'x.jpg': None}
+        assert self.index.type('x.jpg') == 'new'
+
+    def test_invalid(self):
+        """Invalid files aren't uploaded"""
+
+        assert dict(self.scheduler.upload(['z.jpg'])) == {'z.jpg': None}
+
+    def test_progress(self):
+        """Uploads report their aggregate progress"""
+
+        def _(filename, callback=None):
+            callback(50.0, False)
+            return self._upload(filename, callback)
+
+        self.proxy.upload.mock_returns_func = _
+
+        progress = []
+        self.scheduler.callback = lambda p, done: progress.append((p, done))
+
+        list(self.scheduler.upload(['x.jpg', 'y.jpg']))
+
+        assert progress[-1] == (100.0, True), progress
+        assert (25.0, False) in progress, progress
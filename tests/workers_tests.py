@@ -0,0 +1,140 @@
+import threading
+import time
+
+from nose.tools import assert_raises, raises
+
+from pif.workers import Cancelled, Executor, Future, Worker, pipe
+
+
+class TestWorker:
+    """Worker thread tests."""
+
+    def test_result(self):
+        """Worker hands over its result"""
+
+        assert Worker(lambda x, y: x + y, 1, y=2).wait() == 3
+
+    @raises(IOError)
+    def test_exception(self):
+        """Worker raises its exception in the waiter"""
+
+        def _():
+            raise IOError()
+
+        Worker(_).wait()
+
+
+class TestPipe:
+    """Pipe tests."""
+
+    def test_order(self):
+        """Pipe keeps the order of its items"""
+
+        assert list(pipe(xrange(1000), size=3)) == range(1000)
+
+    def test_thread(self):
+        """Pipe consumes its iterable in another thread"""
+
+        def _():
+            yield threading.current_thread()
+
+        assert list(pipe(_())) != [threading.current_thread()]
+
+    @raises(KeyError)
+    def test_exception(self):
+        """Pipe raises the exceptions of its iterable"""
+
+        def _():
+            yield 1
+            raise KeyError()
+
+        list(pipe(_()))
+
+
+class TestExecutor:
+    """Executor tests."""
+
+    def setUp(self):
+        self.dispatched = []
+
+        def _(function, *args):
+            self.dispatched.append(function)
+            function(*args)
+
+        self.executor = Executor({'pair': 2}, dispatch=_)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_result(self):
+        """Executor hands over the result in a future"""
+
+        assert self.executor.submit('a', lambda x, y: x + y, 1, y=2) \
+                   .result() == 3
+
+    @raises(IOError)
+    def test_exception(self):
+        """Executor raises the exception of a job from its future"""
+
+        def _():
+            raise IOError()
+
+        self.executor.submit('a', _).result()
+
+    def test_bounded(self):
+        """Executor runs no more jobs at once than a queue's threads"""
+
+        lock = threading.Lock()
+        running = [0, 0]    # now, at most
+
+        def _():
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+
+            time.sleep(0.01)
+
+            with lock:
+                running[0] -= 1
+
+        futures = [self.executor.submit('pair', _) for i in xrange(8)]
+        map(Future.result, futures)
+
+        assert running[1] == 2
+
+    def test_callback(self):
+        """Executor dispatches the callbacks of a future"""
+
+        results = []
+        called = threading.Event()
+
+        def callback(future):
+            results.append(future.result())
+            called.set()
+
+        future = self.executor.submit('a', lambda: 1)
+        future.add_done_callback(callback)
+        called.wait(5)
+
+        assert results == [1]
+        assert self.dispatched == [callback]
+
+    def test_shutdown(self):
+        """Executor cancels the queued jobs on shutdown"""
+
+        started, event = threading.Event(), threading.Event()
+
+        def _():
+            started.set()
+            event.wait()
+
+        running = self.executor.submit('a', _)
+        queued = self.executor.submit('a', lambda: 1)
+
+        started.wait(5)
+        self.executor.shutdown()
+        event.set()
+
+        assert running.result() is None
+        assert queued.cancelled()
+        assert_raises(Cancelled, queued.result)